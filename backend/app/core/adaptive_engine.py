@@ -2,11 +2,70 @@
 Adaptive Learning Engine for Self-Learning Feedback Loop.
 Handles threshold tuning, layer weight rebalancing, and score calibration.
 """
+import functools
 import hashlib
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional, Dict, List, Tuple
+from sqlalchemy.orm import Session
 from app.core.database import SessionLocal
 
+# Match score buckets used for threshold analysis (low inclusive, high exclusive)
+SCORE_RANGES = [(0, 30), (30, 50), (50, 70), (70, 100)]
+
+# Detection layers that feedback can be attributed to
+DETECTION_LAYERS = ['semantic', 'stylometry', 'cross_lang', 'paraphrase']
+
+# Seconds an analytics result stays valid while no new feedback arrives
+ANALYTICS_CACHE_TTL = 60
+
+
+def ttl_cached(seconds: float):
+    """
+    Cache an AdaptiveEngine method result for `seconds`.
+    
+    Entries are keyed on the latest feedback id, so any new feedback
+    invalidates them before the TTL runs out. Only for read-only methods:
+    a cache hit skips the method body, including any writes it makes.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, db: Optional[Session] = None):
+            version = self._feedback_version(db)
+            cached = self._analytics_cache.get(method.__name__)
+            now = time.monotonic()
+            if cached and cached[1] == version and now - cached[0] < seconds:
+                return cached[2]
+            
+            result = method(self, db)
+            self._analytics_cache[method.__name__] = (now, version, result)
+            return result
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=1)
+def _score_bucket():
+    """
+    Labeled CASE expression mapping match_score to its SCORE_RANGES index.
+    
+    Built once and reused so repeated threshold calculations don't rebuild
+    the expression tree; SQLAlchemy's statement cache then reuses the
+    compiled SQL as well.
+    """
+    from app.core.models import Feedback
+    from sqlalchemy import case, and_
+    
+    return case(
+        *[
+            (and_(Feedback.match_score >= low, Feedback.match_score < high), i)
+            for i, (low, high) in enumerate(SCORE_RANGES)
+        ],
+        else_=None
+    ).label("bucket")
+
 
 class AdaptiveEngine:
     """
@@ -21,19 +80,38 @@ class AdaptiveEngine:
     
     def __init__(self):
         self._min_feedback_for_learning = 10
-        self._cache_weights = None
-        self._cache_timestamp = None
+        self._analytics_cache = {}  # {method_name: (timestamp, feedback_version, result)}
+        self._retrain_lock = threading.Lock()  # One retrain at a time per process
     
     def _get_db(self):
         """Get database session."""
         return SessionLocal()
     
-    def get_or_create_weights(self) -> Dict:
+    @contextmanager
+    def _session(self, db: Optional[Session] = None):
+        """Use the caller's session if given, otherwise open and close a new one."""
+        if db is not None:
+            yield db
+            return
+        db = self._get_db()
+        try:
+            yield db
+        finally:
+            db.close()
+    
+    def _feedback_version(self, db: Optional[Session] = None):
+        """Cheap change marker for the feedback table (latest feedback id)."""
+        from app.core.models import Feedback
+        from sqlalchemy import func
+        
+        with self._session(db) as db:
+            return db.query(func.max(Feedback.id)).scalar()
+    
+    def get_or_create_weights(self, db: Optional[Session] = None) -> Dict:
         """Get current layer weights, creating default if none exist."""
         from app.core.models import LayerWeights
         
-        db = self._get_db()
-        try:
+        with self._session(db) as db:
             weights = db.query(LayerWeights).first()
             if not weights:
                 weights = LayerWeights(
@@ -47,11 +125,10 @@ class AdaptiveEngine:
                 db.add(weights)
                 db.commit()
                 db.refresh(weights)
+                self._analytics_cache.pop('get_analytics', None)
             return weights.to_dict()
-        finally:
-            db.close()
     
-    def calculate_adaptive_threshold(self) -> Tuple[float, Dict]:
+    def calculate_adaptive_threshold(self, db: Optional[Session] = None) -> Tuple[float, Dict]:
         """
         Calculate adaptive threshold based on feedback patterns.
         
@@ -61,32 +138,34 @@ class AdaptiveEngine:
         from app.core.models import Feedback, LayerWeights
         from sqlalchemy import func
         
-        db = self._get_db()
-        try:
-            # Get feedback statistics by score range
-            total = db.query(Feedback).count()
+        with self._session(db) as db:
+            # Feedback totals by type in a single round trip
+            type_counts = dict(
+                db.query(Feedback.feedback_type, func.count(Feedback.id))
+                .group_by(Feedback.feedback_type)
+                .all()
+            )
+            total = sum(type_counts.values())
             
             if total < self._min_feedback_for_learning:
                 weights = db.query(LayerWeights).first()
                 base = weights.base_threshold if weights else 40.0
                 return base, {"learning_active": False, "feedback_needed": self._min_feedback_for_learning - total}
             
-            # Analyze feedback by score ranges
-            score_ranges = [(0, 30), (30, 50), (50, 70), (70, 100)]
-            range_stats = []
+            # Analyze feedback by score ranges: bucket every row with a CASE
+            # expression and count per (bucket, type) in one grouped query
+            bucket = _score_bucket()
+            bucket_counts = {
+                (b, feedback_type): count
+                for b, feedback_type, count in db.query(
+                    bucket, Feedback.feedback_type, func.count(Feedback.id)
+                ).group_by(bucket, Feedback.feedback_type).all()
+            }
             
-            for low, high in score_ranges:
-                fp_count = db.query(Feedback).filter(
-                    Feedback.feedback_type == 'false_positive',
-                    Feedback.match_score >= low,
-                    Feedback.match_score < high
-                ).count()
-                
-                confirmed_count = db.query(Feedback).filter(
-                    Feedback.feedback_type == 'confirmed',
-                    Feedback.match_score >= low,
-                    Feedback.match_score < high
-                ).count()
+            range_stats = []
+            for i, (low, high) in enumerate(SCORE_RANGES):
+                fp_count = bucket_counts.get((i, 'false_positive'), 0)
+                confirmed_count = bucket_counts.get((i, 'confirmed'), 0)
                 
                 total_range = fp_count + confirmed_count
                 fp_rate = fp_count / total_range if total_range > 0 else 0
@@ -102,13 +181,11 @@ class AdaptiveEngine:
             optimal_threshold = 40.0  # Default
             for i, stats in enumerate(range_stats):
                 if stats["fp_rate"] < 30 and stats["confirmed"] > 0:
-                    optimal_threshold = score_ranges[i][0]
+                    optimal_threshold = SCORE_RANGES[i][0]
                     break
             
             # Global false positive rate
-            total_fp = db.query(Feedback).filter(
-                Feedback.feedback_type == 'false_positive'
-            ).count()
+            total_fp = type_counts.get('false_positive', 0)
             global_fp_rate = total_fp / total if total > 0 else 0
             
             # Calculate adjustment: more FPs → raise threshold
@@ -122,6 +199,8 @@ class AdaptiveEngine:
                 weights.total_feedback_processed = total
                 weights.updated_at = datetime.utcnow()
                 db.commit()
+                # Analytics embed the current weights
+                self._analytics_cache.pop('get_analytics', None)
             
             effective_threshold = (weights.base_threshold if weights else 40.0) + adjustment
             
@@ -133,10 +212,8 @@ class AdaptiveEngine:
                 "effective_threshold": round(effective_threshold, 1),
                 "score_range_analysis": range_stats
             }
-        finally:
-            db.close()
     
-    def rebalance_layer_weights(self) -> Dict:
+    def rebalance_layer_weights(self, db: Optional[Session] = None) -> Dict:
         """
         Rebalance detection layer weights based on which layers generate more false positives.
         
@@ -147,20 +224,21 @@ class AdaptiveEngine:
         from app.core.models import Feedback, LayerWeights
         from sqlalchemy import func
         
-        db = self._get_db()
-        try:
-            # Count feedback by detection layer
+        with self._session(db) as db:
+            # Count feedback by detection layer and type in one grouped query
+            layer_counts = {
+                (layer, feedback_type): count
+                for layer, feedback_type, count in db.query(
+                    Feedback.detection_layer, Feedback.feedback_type, func.count(Feedback.id)
+                ).filter(
+                    Feedback.detection_layer.in_(DETECTION_LAYERS)
+                ).group_by(Feedback.detection_layer, Feedback.feedback_type).all()
+            }
+            
             layer_stats = {}
-            for layer in ['semantic', 'stylometry', 'cross_lang', 'paraphrase']:
-                fp_count = db.query(Feedback).filter(
-                    Feedback.feedback_type == 'false_positive',
-                    Feedback.detection_layer == layer
-                ).count()
-                
-                confirmed_count = db.query(Feedback).filter(
-                    Feedback.feedback_type == 'confirmed',
-                    Feedback.detection_layer == layer
-                ).count()
+            for layer in DETECTION_LAYERS:
+                fp_count = layer_counts.get((layer, 'false_positive'), 0)
+                confirmed_count = layer_counts.get((layer, 'confirmed'), 0)
                 
                 total = fp_count + confirmed_count
                 accuracy = confirmed_count / total if total > 0 else 0.5
@@ -206,6 +284,8 @@ class AdaptiveEngine:
                 weights.updated_at = datetime.utcnow()
                 db.commit()
                 db.refresh(weights)
+                # Analytics embed the current weights
+                self._analytics_cache.pop('get_analytics', None)
             
             return {
                 "status": "success",
@@ -217,41 +297,37 @@ class AdaptiveEngine:
                 },
                 "current_weights": weights.to_dict() if weights else None
             }
-        finally:
-            db.close()
     
-    def get_analytics(self) -> Dict:
+    @ttl_cached(ANALYTICS_CACHE_TTL)
+    def get_analytics(self, db: Optional[Session] = None) -> Dict:
         """Get comprehensive feedback analytics."""
         from app.core.models import Feedback, LayerWeights, User
-        from sqlalchemy import func
+        from sqlalchemy import func, case
         
-        db = self._get_db()
-        try:
-            total = db.query(Feedback).count()
-            
-            # Feedback by type
-            false_positives = db.query(Feedback).filter(
-                Feedback.feedback_type == 'false_positive'
-            ).count()
-            confirmed = db.query(Feedback).filter(
-                Feedback.feedback_type == 'confirmed'
-            ).count()
-            
-            # Instructor reviews
-            instructor_reviews = db.query(Feedback).filter(
-                Feedback.is_instructor_review == True
-            ).count()
-            
-            # Average severity
-            avg_severity = db.query(func.avg(Feedback.severity)).scalar() or 50
+        with self._session(db) as db:
+            # Totals, per-type counts and average severity in one aggregate row
+            totals = db.query(
+                func.count(Feedback.id),
+                func.sum(case((Feedback.feedback_type == 'false_positive', 1), else_=0)),
+                func.sum(case((Feedback.feedback_type == 'confirmed', 1), else_=0)),
+                func.sum(case((Feedback.is_instructor_review == True, 1), else_=0)),
+                func.avg(Feedback.severity)
+            ).one()
+            total = totals[0] or 0
+            false_positives = int(totals[1] or 0)
+            confirmed = int(totals[2] or 0)
+            instructor_reviews = int(totals[3] or 0)
+            avg_severity = float(totals[4] or 50)
             
             # Feedback by layer
+            layer_counts = dict(
+                db.query(Feedback.detection_layer, func.count(Feedback.id))
+                .group_by(Feedback.detection_layer)
+                .all()
+            )
             layer_breakdown = {}
-            for layer in ['semantic', 'stylometry', 'cross_lang', 'paraphrase', None]:
-                count = db.query(Feedback).filter(
-                    Feedback.detection_layer == layer
-                ).count()
-                layer_breakdown[layer or 'unspecified'] = count
+            for layer in DETECTION_LAYERS + [None]:
+                layer_breakdown[layer or 'unspecified'] = layer_counts.get(layer, 0)
             
             # Get current weights
             weights = db.query(LayerWeights).first()
@@ -267,19 +343,23 @@ class AdaptiveEngine:
                 "learning_active": total >= self._min_feedback_for_learning,
                 "current_weights": weights.to_dict() if weights else None
             }
-        finally:
-            db.close()
     
-    def trigger_retrain(self) -> Dict:
+    def trigger_retrain(self, db: Optional[Session] = None) -> Dict:
         """
         Trigger incremental retraining based on accumulated feedback.
         This recalculates thresholds and rebalances weights.
+        Returns status "retrain_in_progress" if another retrain is running.
         """
-        # Calculate new threshold
-        threshold, threshold_analytics = self.calculate_adaptive_threshold()
-        
-        # Rebalance layer weights
-        weight_result = self.rebalance_layer_weights()
+        if not self._retrain_lock.acquire(blocking=False):
+            return {"status": "retrain_in_progress"}
+        try:
+            # Calculate new threshold
+            threshold, threshold_analytics = self.calculate_adaptive_threshold(db)
+            
+            # Rebalance layer weights
+            weight_result = self.rebalance_layer_weights(db)
+        finally:
+            self._retrain_lock.release()
         
         return {
             "status": "retrain_complete",
@@ -21,13 +21,24 @@ from urllib.parse import quote_plus
 # Build connection URL
 encoded_password = quote_plus(MYSQL_PASSWORD)
 encoded_user = quote_plus(MYSQL_USER)
-DATABASE_URL = f"mysql+pymysql://{encoded_user}:{encoded_password}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DATABASE}"
+DATABASE_URL = f"mysql+pymysql://{encoded_user}:{encoded_password}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DATABASE}?charset=utf8mb4"
+
+# Connection pool sizing
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
 
 # Create engine
 engine = create_engine(
     DATABASE_URL,
+    pool_size=DB_POOL_SIZE,          # Persistent connections kept in the pool
+    max_overflow=DB_MAX_OVERFLOW,    # Extra connections allowed under burst load
+    pool_use_lifo=True,  # Reuse the most recent connection so idle ones can expire
     pool_pre_ping=True,  # Check connection before using
     pool_recycle=3600,   # Recycle connections after 1 hour
+    isolation_level="READ COMMITTED",  # Count-heavy analytics skip InnoDB gap locks
+    insertmanyvalues_page_size=1000,   # Rows per multi-VALUES INSERT in bulk inserts
+    query_cache_size=1200,             # Compiled SQL statements kept per engine
+    future=True,
     echo=False           # Set to True for SQL debugging
 )
 
@@ -47,8 +58,90 @@ def get_db():
         db.close()
 
 
+def _add_missing_columns():
+    """
+    Add model columns missing from existing tables.
+    create_all() only creates new tables, so columns added to a model
+    after its table exists are applied here with ALTER TABLE.
+    """
+    from sqlalchemy import inspect, text
+    
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+                print(f"Added column {table.name}.{column.name}")
+
+
+def _add_missing_indexes():
+    """Create model indexes missing from existing tables (create_all() skips them)."""
+    from sqlalchemy import inspect
+    
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {idx["name"] for idx in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                index.create(bind=conn)
+                print(f"Added index {table.name}.{index.name}")
+
+
+def _convert_feedback_hash_to_binary():
+    """
+    Convert feedback.submitted_text_hash from a hex string column to raw digest bytes.
+    Existing SHA-256 hex values are decoded in place with UNHEX() into 32-byte
+    digests; _mark_feedback_hash_algorithm() then labels them 'sha256'.
+    """
+    from sqlalchemy import String, inspect, text
+    
+    inspector = inspect(engine)
+    if not inspector.has_table("feedback"):
+        return
+    columns = {col["name"]: col["type"] for col in inspector.get_columns("feedback")}
+    if not isinstance(columns.get("submitted_text_hash"), String):
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE feedback MODIFY submitted_text_hash VARBINARY(64) NOT NULL"))
+        conn.execute(text("UPDATE feedback SET submitted_text_hash = UNHEX(submitted_text_hash)"))
+        conn.execute(text("ALTER TABLE feedback MODIFY submitted_text_hash VARBINARY(32) NOT NULL"))
+    print("Converted feedback.submitted_text_hash to binary digests")
+
+
+def _mark_feedback_hash_algorithm():
+    """
+    Record the digest algorithm on feedback rows that predate text_hash_algorithm.
+    The digest length tells them apart: 32 bytes are legacy SHA-256 values
+    converted from hex, 16 bytes are BLAKE2b-128.
+    """
+    from sqlalchemy import inspect, text
+    
+    if not inspect(engine).has_table("feedback"):
+        return
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE feedback SET text_hash_algorithm = "
+            "CASE WHEN LENGTH(submitted_text_hash) = 32 THEN 'sha256' ELSE 'blake2b-128' END "
+            "WHERE text_hash_algorithm IS NULL"
+        ))
+
+
 def init_db():
     """Initialize database tables."""
     from app.core.models import User, Activity, ReferenceDocument, UserDocument  # Import models
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+    _add_missing_indexes()
+    _convert_feedback_hash_to_binary()
+    _mark_feedback_hash_algorithm()
     print("Database tables created successfully!")
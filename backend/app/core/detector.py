@@ -1,180 +1,704 @@
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import os
+import threading
+import numpy as np
 import torch
-import pickle
+import torch.nn.functional as F
 from app.core.stylometry import stylometer
 from app.core.language_utils import detect_language
 
+try:
+    import faiss
+except ImportError:  # ANN search is optional; fall back to exact cosine scan
+    faiss = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # JIT threshold kernel is optional; NumPy is used instead
+    njit = None
+
 # Model version for cache invalidation (increment when changing models)
 MODEL_VERSION = "multilingual-v1"
 
+# Dynamic int8 quantization of the encoder's Linear layers when running on CPU
+QUANTIZE_CPU_MODEL = os.getenv("QUANTIZE_CPU_MODEL", "1") == "1"
+
+# Batch size for bulk SentenceTransformer.encode calls
+ENCODE_BATCH_SIZE = 64
+
+# Rows fetched per round trip when streaming embeddings out of the database
+LOAD_BATCH_SIZE = 256
+
+# Generous upper bound on characters per token, used to cut long texts before
+# tokenization; the model only sees its first max_seq_length tokens anyway
+MAX_CHARS_PER_TOKEN = 10
+
+# Maximum number of matches returned per detection
+MAX_MATCHES = 20
+
+# Exact scans at least this large use the parallel Numba threshold kernel
+NUMBA_MIN_DOCUMENTS = 5000
+
+# Approximate nearest-neighbour (HNSW) search settings for large reference sets
+ANN_MIN_DOCUMENTS = 5000  # Exact scan is fast enough below this size
+ANN_HNSW_M = 32
+ANN_EF_SEARCH = 64
+
+# Query result cache: exact-text LRU plus reuse of match candidates for near-identical queries
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_SIMILARITY = 0.98
+
+# Threads running stylometric analysis alongside the encoder forward pass
+STYLOMETRY_WORKERS = 4
+
+# On-disk dtype for stored embeddings (raw little-endian bytes, no pickle)
+EMBEDDING_DTYPE = np.float16
+
+
+def serialize_embedding(embedding: torch.Tensor) -> bytes:
+    """Serialize an embedding tensor as raw float16 bytes."""
+    return embedding.detach().cpu().to(torch.float16).numpy().tobytes()
+
+
+def deserialize_embedding(blob: bytes, dim: int):
+    """
+    Decode a raw float16 embedding blob into a NumPy vector.
+    Returns None for missing blobs and legacy pickled tensors.
+    """
+    if not blob or len(blob) != dim * np.dtype(EMBEDDING_DTYPE).itemsize:
+        return None
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+
+
+def _ensure_rows(matrix: np.ndarray, rows: int) -> np.ndarray:
+    """Return matrix with room for at least `rows` rows, doubling its capacity when full."""
+    if rows <= matrix.shape[0]:
+        return matrix
+    grown = np.empty((max(rows, 2 * matrix.shape[0]), matrix.shape[1]), dtype=matrix.dtype)
+    grown[:matrix.shape[0]] = matrix
+    return grown
+
+
+# Cross-user candidate metadata kept after its embedding blob has been decoded
+_UserDocRow = namedtuple("_UserDocRow", "id user_id doc_id language_code email")
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _indices_above_numba(scores, threshold):
+        """Parallel scan marking scores above threshold, then gather their indices."""
+        mask = np.empty(scores.shape[0], dtype=np.bool_)
+        for i in prange(scores.shape[0]):
+            mask[i] = scores[i] > threshold
+        return np.nonzero(mask)[0]
+
+
+def filter_top_k(scores: np.ndarray, threshold: float, k: int):
+    """
+    Return (indices, scores) of the k best scores above threshold, best first.
+    Uses the Numba kernel for large arrays when available, NumPy otherwise.
+    """
+    if njit is not None and scores.shape[0] >= NUMBA_MIN_DOCUMENTS:
+        ids = _indices_above_numba(scores, threshold)
+    else:
+        ids = np.nonzero(scores > threshold)[0]
+    
+    # Partial sort: only the k best candidates get fully ordered
+    if ids.shape[0] > k:
+        ids = ids[np.argpartition(-scores[ids], k - 1)[:k]]
+    ids = ids[np.argsort(-scores[ids], kind="stable")]
+    return ids, scores[ids]
+
+
+def filter_top_k_tensor(scores: torch.Tensor, threshold: float, k: int):
+    """
+    Device-side counterpart of filter_top_k: mask and topk stay on the
+    GPU and only the k selected (indices, scores) are copied to the host.
+    """
+    ids = (scores > threshold).nonzero(as_tuple=True)[0]
+    top_scores, top = torch.topk(scores[ids], min(k, ids.shape[0]))
+    return ids[top].cpu().numpy(), top_scores.cpu().numpy()
+
 
 class PlagiarismDetector:
     def __init__(self):
-        # Load multilingual model for cross-language semantic similarity
-        print("Loading Multilingual SBERT model (50+ languages)...")
-        self.model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-        print("Multilingual model loaded.")
+        # Model and reference embeddings stay resident on the GPU when available
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.quantized = self.device == "cpu" and QUANTIZE_CPU_MODEL
         
-        # In-memory cache for performance (loaded from DB on startup)
-        self.documents = []
+        # Stored reference embeddings are reused only when produced by the same model variant
+        self.model_version = f"{MODEL_VERSION}-int8" if self.quantized else MODEL_VERSION
+        
+        # In-memory cache for performance (loaded from DB on startup),
+        # stored as parallel arrays indexed like the rows of self.embeddings.
+        # Embeddings are kept L2-normalized so cosine similarity is a plain matmul
+        self.doc_ids = []
+        self.doc_texts = []
+        self.doc_langs = []
         self.embeddings = None
+        self._id_to_index = {}  # doc_id -> position in the parallel arrays
         self._db_initialized = False
+        self._memory_only = False  # Set when the database could not be loaded
+        self._pending_ids = set()  # doc_ids being added, claimed under _lock
+        
+        # Guards the reference arrays, embedding buffer and ANN index: detection
+        # and reference updates run in worker threads. Held for every mutation
+        # and for each search plus the result building that indexes the arrays
+        self._lock = threading.RLock()
+        
+        # Quantized HNSW index over normalized embeddings, rebuilt lazily when dirty
+        self._ann_index = None
+        self._ann_dirty = True
+        
+        # Recent detect() results, dropped whenever the reference set changes
+        self._query_cache = OrderedDict()  # (text hash, threshold) -> result
+        self._recent_queries = deque(maxlen=QUERY_CACHE_SIZE)  # (embedding, threshold, match positions)
+        self._cache_lock = threading.Lock()  # detect() runs in worker threads
+        self._cache_generation = 0
+        self._previews_cache = None  # (generation, etag, previews) for list_references
+        
+        # Stacked user-document embeddings for cross-user detection:
+        # (version, matrix, owner ids, rows), rebuilt when the table changes
+        self._cross_user_cache = None
+        self._cross_user_lock = threading.Lock()
+        
+        # Stylometry is pure Python; overlapping it with encode hides most of its latency
+        self._stylometry_pool = ThreadPoolExecutor(
+            max_workers=STYLOMETRY_WORKERS, thread_name_prefix="stylometry"
+        )
+    
+    def _invalidate_query_cache(self):
+        """Forget cached detections; match positions are only valid for the current references."""
+        with self._cache_lock:
+            self._query_cache.clear()
+            self._recent_queries.clear()
+            self._cache_generation += 1
+    
+    @property
+    def embeddings(self):
+        """Reference embedding matrix: a zero-copy view of the growth buffer, or None."""
+        if self._emb_buffer is None or self._emb_len == 0:
+            return None
+        return self._emb_buffer[:self._emb_len]
+    
+    @embeddings.setter
+    def embeddings(self, value):
+        self._emb_buffer = value
+        self._emb_len = 0 if value is None else value.shape[0]
+    
+    def _append_embeddings(self, rows: torch.Tensor):
+        """Append rows, doubling the buffer capacity when full (amortized O(1) per row)."""
+        needed = self._emb_len + rows.shape[0]
+        capacity = 0 if self._emb_buffer is None else self._emb_buffer.shape[0]
+        if needed > capacity:
+            buffer = torch.empty(
+                (max(needed, 2 * capacity), rows.shape[1]), dtype=rows.dtype, device=rows.device
+            )
+            if self._emb_len:
+                buffer[:self._emb_len] = self._emb_buffer[:self._emb_len]
+            self._emb_buffer = buffer
+        self._emb_buffer[self._emb_len:needed] = rows
+        self._emb_len = needed
+    
+    @functools.cached_property
+    def model(self) -> SentenceTransformer:
+        """Multilingual model for cross-language semantic similarity, loaded on first use."""
+        print(f"Loading Multilingual SBERT model (50+ languages) on {self.device}...")
+        model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2', device=self.device)
+        if self.quantized:
+            # int8 weights for the attention/FFN matmuls; activations and
+            # output embeddings stay float32
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        print("Multilingual model loaded.")
+        return model
+    
+    def _encode(self, texts, **kwargs):
+        """
+        Run model.encode; on GPU the transformer forward pass runs under
+        bf16/fp16 autocast and the output is cast back to float32.
+        Texts are pre-cut so the tokenizer never walks whole long documents.
+        """
+        max_chars = self.model.max_seq_length * MAX_CHARS_PER_TOKEN
+        if isinstance(texts, str):
+            texts = texts[:max_chars]
+        else:
+            texts = [text[:max_chars] for text in texts]
+        
+        if self.device != "cuda":
+            return self.model.encode(texts, **kwargs)
+        
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        with torch.autocast(device_type="cuda", dtype=dtype):
+            embeddings = self.model.encode(texts, **kwargs)
+        
+        # Normalize, similarity and storage stay in float32
+        if isinstance(embeddings, torch.Tensor):
+            return embeddings.float()
+        return embeddings.astype(np.float32, copy=False)
     
     def _get_db(self):
         """Get database session."""
         from app.core.database import SessionLocal
         return SessionLocal()
     
+    def warm_up(self):
+        """Load the model and the reference cache ahead of the first request."""
+        _ = self.model
+        self._load_from_db()
+    
+    def _ann_vectors(self, embeddings: torch.Tensor) -> np.ndarray:
+        """L2-normalized float32 copy of embeddings (inner product == cosine)."""
+        vectors = embeddings.detach().cpu().numpy().astype(np.float32).reshape(-1, embeddings.shape[-1])
+        faiss.normalize_L2(vectors)
+        return vectors
+    
+    def _get_ann_index(self):
+        """Return the HNSW index, or None when exact search should be used."""
+        if faiss is None or self.embeddings is None or len(self.doc_ids) < ANN_MIN_DOCUMENTS:
+            return None
+        
+        if self._ann_dirty or self._ann_index is None:
+            # HNSW graph over 8-bit scalar-quantized vectors: 4x less memory
+            # than float32 and similarity is computed on the int8 codes
+            index = faiss.IndexHNSWSQ(
+                self.embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit,
+                ANN_HNSW_M, faiss.METRIC_INNER_PRODUCT
+            )
+            index.hnsw.efSearch = ANN_EF_SEARCH
+            vectors = self._ann_vectors(self.embeddings)
+            index.train(vectors)
+            index.add(vectors)
+            self._ann_index = index
+            self._ann_dirty = False
+        return self._ann_index
+    
+    def _top_matches(self, query_embedding: torch.Tensor, threshold: float):
+        """
+        Return (document index, cosine score) pairs above threshold,
+        best first and capped at MAX_MATCHES. Expects a unit-norm query.
+        """
+        index = self._get_ann_index()
+        if index is not None:
+            k = min(MAX_MATCHES, len(self.doc_ids))
+            scores, ids = index.search(self._ann_vectors(query_embedding), k)
+            scores, ids = scores[0], ids[0]
+        else:
+            # One GEMV on unit vectors, then a vectorized threshold + top-k.
+            # On GPU the selection runs on device so only k scores come back;
+            # on CPU the NumPy/Numba path avoids the topk sort overhead
+            scores = self.embeddings @ query_embedding
+            if scores.is_cuda:
+                ids, scores = filter_top_k_tensor(scores, threshold, MAX_MATCHES)
+            else:
+                ids, scores = filter_top_k(scores.numpy(), threshold, MAX_MATCHES)
+        
+        return [(int(i), float(score)) for i, score in zip(ids, scores) if i >= 0 and score > threshold]
+    
+    def _similar_query_candidates(self, query_embedding: torch.Tensor, threshold: float):
+        """Match positions of a recent near-identical query at the same threshold, or None."""
+        with self._cache_lock:
+            candidates = [entry for entry in self._recent_queries if entry[1] == threshold]
+        if not candidates:
+            return None
+        similarities = torch.stack([entry[0] for entry in candidates]) @ query_embedding
+        best = int(torch.argmax(similarities))
+        if float(similarities[best]) < QUERY_CACHE_SIMILARITY:
+            return None
+        return candidates[best][2]
+    
+    def _rescore_matches(self, ids: list, query_embedding: torch.Tensor, threshold: float):
+        """
+        Score only the given reference positions against the query (a k-row
+        matmul) and return them like _top_matches: above threshold, best first.
+        """
+        if not ids:
+            return []
+        scores = (self.embeddings[ids] @ query_embedding).tolist()
+        matches = [(i, score) for i, score in zip(ids, scores) if score > threshold]
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches
+    
     def _load_from_db(self):
         """Load all references from database into memory."""
         if self._db_initialized:
             return
+        # Double-checked: concurrent first calls wait for one load
+        with self._lock:
+            if self._db_initialized:
+                return
             
-        try:
-            from app.core.models import ReferenceDocument
-            db = self._get_db()
             try:
-                refs = db.query(ReferenceDocument).all()
-                needs_reembed = 0
-                for ref in refs:
-                    lang_info = detect_language(ref.text)
-                    entry = {"id": ref.doc_id, "text": ref.text, "language": lang_info}
-                    self.documents.append(entry)
+                from app.core.models import ReferenceDocument
+                db = self._get_db()
+                try:
+                    from sqlalchemy import func
                     
-                    # Always regenerate embeddings with new multilingual model
-                    # (Previous embeddings were from English-only model)
-                    embedding = self.model.encode(ref.text, convert_to_tensor=True)
-                    needs_reembed += 1
+                    # Fill one preallocated matrix instead of growing a tensor per row
+                    dim = self.model.get_sentence_embedding_dimension()
+                    expected = db.query(func.count(ReferenceDocument.id)).scalar() or 0
+                    matrix = np.empty((expected, dim), dtype=np.float32)
                     
-                    if self.embeddings is None:
-                        self.embeddings = embedding.unsqueeze(0)
-                    else:
-                        self.embeddings = torch.cat((self.embeddings, embedding.unsqueeze(0)), dim=0)
-                
+                    # Stream rows so only one batch of blobs is materialized at a time;
+                    # stale rows are re-embedded in batches as they accumulate
+                    refs = db.query(
+                        ReferenceDocument.id,
+                        ReferenceDocument.doc_id,
+                        ReferenceDocument.text,
+                        ReferenceDocument.embedding,
+                        ReferenceDocument.model_version,
+                        ReferenceDocument.language_code,
+                        ReferenceDocument.language_name
+                    ).yield_per(LOAD_BATCH_SIZE)
+                    
+                    pending = []  # (row, reference id, text) awaiting re-embedding
+                    reembedded = []
+                    missing_language = []
+                    
+                    def reembed_pending():
+                        rows = [row for row, _, _ in pending]
+                        matrix[rows] = self._encode(
+                            [text for _, _, text in pending],
+                            batch_size=ENCODE_BATCH_SIZE,
+                            convert_to_numpy=True,
+                            show_progress_bar=False
+                        )
+                        reembedded.extend(
+                            {
+                                "id": ref_id,
+                                "embedding": matrix[row].astype(EMBEDDING_DTYPE).tobytes(),
+                                "model_version": self.model_version
+                            }
+                            for row, ref_id, _ in pending
+                        )
+                        pending.clear()
+                    
+                    count = 0
+                    for ref in refs:
+                        # Rows inserted after the count query still fit
+                        matrix = _ensure_rows(matrix, count + 1)
+                        
+                        # Language is stored on insert; only legacy rows need detection
+                        if ref.language_code is None:
+                            lang_info = detect_language(ref.text)
+                            missing_language.append(
+                                {"id": ref.id, "language_code": lang_info["code"], "language_name": lang_info["name"]}
+                            )
+                        else:
+                            lang_info = {"code": ref.language_code, "name": ref.language_name}
+                        
+                        self.doc_ids.append(ref.doc_id)
+                        self.doc_texts.append(ref.text)
+                        self.doc_langs.append(lang_info)
+                        self._id_to_index[ref.doc_id] = count
+                        
+                        # Only trust stored embeddings produced by the current model
+                        stored = None
+                        if ref.model_version == self.model_version:
+                            stored = deserialize_embedding(ref.embedding, dim)
+                        if stored is None:
+                            pending.append((count, ref.id, ref.text))
+                            if len(pending) >= LOAD_BATCH_SIZE:
+                                reembed_pending()
+                        else:
+                            matrix[count] = stored
+                        count += 1
+                    
+                    if pending:
+                        reembed_pending()
+                    matrix = matrix[:count]
+                    
+                    # Write re-embedded references back so the next start can reuse them
+                    needs_reembed = len(reembedded)
+                    if reembedded:
+                        try:
+                            db.bulk_update_mappings(ReferenceDocument, reembedded)
+                            db.commit()
+                        except Exception as e:
+                            db.rollback()
+                            print(f"Warning: Could not store re-embedded references: {e}")
+                    
+                    # Persist languages detected for legacy rows
+                    if missing_language:
+                        try:
+                            db.bulk_update_mappings(ReferenceDocument, missing_language)
+                            db.commit()
+                        except Exception as e:
+                            db.rollback()
+                            print(f"Warning: Could not store reference languages: {e}")
+                    
+                    if count:
+                        self.embeddings = F.normalize(
+                            torch.from_numpy(matrix).to(self.device), dim=1
+                        ).contiguous()
+                        self._ann_dirty = True
+                        self._invalidate_query_cache()
+                    
+                    self._db_initialized = True
+                    if needs_reembed > 0:
+                        print(f"Re-embedded {needs_reembed} references with multilingual model.")
+                    print(f"Loaded {count} references from database.")
+                finally:
+                    db.close()
+            except Exception as e:
+                print(f"Warning: Could not load from database: {e}")
+                self._memory_only = True  # Keep references in memory only
                 self._db_initialized = True
-                if needs_reembed > 0:
-                    print(f"Re-embedded {needs_reembed} references with multilingual model.")
-                print(f"Loaded {len(refs)} references from database.")
-            finally:
-                db.close()
-        except Exception as e:
-            print(f"Warning: Could not load from database: {e}")
-            self._db_initialized = True
 
-    def add_document(self, doc_id: str, text: str):
+    def add_document(self, doc_id: str, text: str) -> dict:
         """Adds a document to the reference database."""
+        return self.add_documents([(doc_id, text)])[0]
+    
+    def add_documents(self, pairs: list) -> list:
+        """
+        Adds many (doc_id, text) documents to the reference database.
+        Encodes all new texts in one batched call and inserts them in one commit.
+        Returns a result per pair, in order, with status "added" (plus the
+        detected language), "exists" (already stored or repeated in the batch)
+        or "error" (could not be saved). Only saved documents enter the cache.
+        """
         self._load_from_db()  # Ensure DB is loaded
         
-        # Detect language
-        lang_info = detect_language(text)
-        
-        embedding = self.model.encode(text, convert_to_tensor=True)
+        # Claim new ids under the lock so concurrent uploads of the same
+        # doc_id cannot both pass the duplicate check while encoding
+        results = [{"status": "exists", "doc_id": doc_id} for doc_id, _ in pairs]
+        new_docs = []  # (position, doc_id, text)
+        with self._lock:
+            for pos, (doc_id, text) in enumerate(pairs):
+                if doc_id in self._id_to_index or doc_id in self._pending_ids:
+                    continue
+                self._pending_ids.add(doc_id)
+                new_docs.append((pos, doc_id, text))
+        if not new_docs:
+            return results
         
-        # Save to database
         try:
-            from app.core.models import ReferenceDocument
-            db = self._get_db()
-            try:
-                # Serialize embedding for storage
-                embedding_bytes = pickle.dumps(embedding.cpu())
+            texts = [text for _, _, text in new_docs]
+            
+            # Detect languages
+            lang_infos = [detect_language(text) for text in texts]
+            
+            embeddings = self._encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_tensor=True,
+                device=self.device,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+            
+            if self._memory_only:
+                statuses = ["added"] * len(new_docs)
+            else:
+                statuses = self._insert_references([
+                    {
+                        "doc_id": doc_id,
+                        "text": text,
+                        "embedding": serialize_embedding(embedding),
+                        "model_version": self.model_version,
+                        "language_code": lang_info["code"],
+                        "language_name": lang_info["name"]
+                    }
+                    for (_, doc_id, text), embedding, lang_info in zip(new_docs, embeddings, lang_infos)
+                ])
+            
+            added = [i for i, status in enumerate(statuses) if status == "added"]
+            
+            # Update in-memory cache with the saved documents only
+            with self._lock:
+                for i in added:
+                    _, doc_id, text = new_docs[i]
+                    self._id_to_index[doc_id] = len(self.doc_ids)
+                    self.doc_ids.append(doc_id)
+                    self.doc_texts.append(text)
+                    self.doc_langs.append(lang_infos[i])
                 
-                ref = ReferenceDocument(
-                    doc_id=doc_id,
-                    text=text,
-                    embedding=embedding_bytes
-                )
-                db.add(ref)
-                db.commit()
-            finally:
-                db.close()
+                if added:
+                    added_embeddings = embeddings[added]
+                    self._append_embeddings(added_embeddings)
+                    
+                    # Extend the ANN index in place; ids stay aligned with the parallel arrays
+                    if self._ann_index is not None and not self._ann_dirty:
+                        self._ann_index.add(self._ann_vectors(added_embeddings))
+                    
+                    self._invalidate_query_cache()
+            
+            for (pos, doc_id, _), status, lang_info in zip(new_docs, statuses, lang_infos):
+                results[pos] = {"status": status, "doc_id": doc_id}
+                if status == "added":
+                    results[pos]["language"] = lang_info
         except Exception as e:
-            print(f"Warning: Could not save to database: {e}")
-        
-        # Update in-memory cache with language info
-        entry = {"id": doc_id, "text": text, "language": lang_info}
-        self.documents.append(entry)
-        
-        if self.embeddings is None:
-            self.embeddings = embedding.unsqueeze(0)
-        else:
-            self.embeddings = torch.cat((self.embeddings, embedding.unsqueeze(0)), dim=0)
+            print(f"Warning: Could not add references: {e}")
+            for pos, doc_id, _ in new_docs:
+                results[pos] = {"status": "error", "doc_id": doc_id}
+        finally:
+            with self._lock:
+                self._pending_ids.difference_update(doc_id for _, doc_id, _ in new_docs)
+        return results
+    
+    def _insert_references(self, rows: list) -> list:
+        """
+        Insert reference rows with one executemany INSERT. If that fails (one
+        duplicate doc_id fails the whole statement), retry row by row so the
+        rest still get saved. Returns "added", "exists" or "error" per row.
+        """
+        from app.core.models import ReferenceDocument
+        from sqlalchemy import insert
+        from sqlalchemy.exc import IntegrityError
         
-        return lang_info
+        db = self._get_db()
+        try:
+            try:
+                db.execute(insert(ReferenceDocument), rows)
+                db.commit()
+                return ["added"] * len(rows)
+            except Exception as e:
+                db.rollback()
+                print(f"Warning: Batch insert of {len(rows)} references failed, retrying one by one: {e}")
+            
+            statuses = []
+            for row in rows:
+                try:
+                    db.execute(insert(ReferenceDocument), [row])
+                    db.commit()
+                    statuses.append("added")
+                except IntegrityError:
+                    db.rollback()
+                    statuses.append("exists")  # Stored meanwhile, e.g. by another worker
+                except Exception as e:
+                    db.rollback()
+                    print(f"Warning: Could not save reference '{row['doc_id']}': {e}")
+                    statuses.append("error")
+            return statuses
+        finally:
+            db.close()
     
     def remove_document(self, doc_id: str) -> bool:
         """Remove a document from the database and cache."""
         self._load_from_db()
         
-        # Find index in cache
-        index_to_remove = None
-        for i, doc in enumerate(self.documents):
-            if doc["id"] == doc_id:
-                index_to_remove = i
-                break
-        
-        if index_to_remove is None:
-            return False
-        
-        # Remove from database
-        try:
-            from app.core.models import ReferenceDocument
-            db = self._get_db()
+        with self._lock:
+            # Find index in cache
+            index_to_remove = self._id_to_index.get(doc_id)
+            if index_to_remove is None:
+                return False
+            
+            # Remove from database
             try:
-                ref = db.query(ReferenceDocument).filter(ReferenceDocument.doc_id == doc_id).first()
-                if ref:
-                    db.delete(ref)
-                    db.commit()
-            finally:
-                db.close()
-        except Exception as e:
-            print(f"Warning: Could not delete from database: {e}")
-        
-        # Remove from cache
-        self.documents.pop(index_to_remove)
-        
-        if self.embeddings is not None:
-            if len(self.documents) == 0:
-                self.embeddings = None
-            else:
-                indices = list(range(self.embeddings.shape[0]))
-                indices.pop(index_to_remove)
-                self.embeddings = self.embeddings[indices]
-        
-        return True
+                from app.core.models import ReferenceDocument
+                db = self._get_db()
+                try:
+                    ref = db.query(ReferenceDocument).filter(ReferenceDocument.doc_id == doc_id).first()
+                    if ref:
+                        db.delete(ref)
+                        db.commit()
+                finally:
+                    db.close()
+            except Exception as e:
+                print(f"Warning: Could not delete from database: {e}")
+            
+            # Remove from cache by moving the last document into the freed slot:
+            # O(1), with no shifting of later positions or copying of the matrix
+            last = len(self.doc_ids) - 1
+            if index_to_remove != last:
+                moved_id = self.doc_ids[last]
+                self.doc_ids[index_to_remove] = moved_id
+                self.doc_texts[index_to_remove] = self.doc_texts[last]
+                self.doc_langs[index_to_remove] = self.doc_langs[last]
+                self._id_to_index[moved_id] = index_to_remove
+                if self._emb_buffer is not None:
+                    self._emb_buffer[index_to_remove] = self._emb_buffer[last]
+            self.doc_ids.pop()
+            self.doc_texts.pop()
+            self.doc_langs.pop()
+            del self._id_to_index[doc_id]
+            self._emb_len = max(self._emb_len - 1, 0)
+            
+            # A document changed position, so rebuild the ANN index on next search
+            self._ann_dirty = True
+            self._invalidate_query_cache()
+            
+            return True
     
     def clear_all_documents(self):
         """Clear all documents from database and cache."""
-        try:
-            from app.core.models import ReferenceDocument
-            db = self._get_db()
+        with self._lock:
             try:
-                db.query(ReferenceDocument).delete()
-                db.commit()
-            finally:
-                db.close()
-        except Exception as e:
-            print(f"Warning: Could not clear database: {e}")
-        
-        self.documents = []
-        self.embeddings = None
+                from app.core.models import ReferenceDocument
+                db = self._get_db()
+                try:
+                    db.query(ReferenceDocument).delete()
+                    db.commit()
+                finally:
+                    db.close()
+            except Exception as e:
+                print(f"Warning: Could not clear database: {e}")
+            
+            self.doc_ids = []
+            self.doc_texts = []
+            self.doc_langs = []
+            self.embeddings = None
+            self._id_to_index = {}
+            self._ann_index = None
+            self._ann_dirty = True
+            self._invalidate_query_cache()
+    
+    def _document_dict(self, index: int) -> dict:
+        """Build the public dict view of the document at `index`."""
+        return {"id": self.doc_ids[index], "text": self.doc_texts[index], "language": self.doc_langs[index]}
     
     def get_document(self, doc_id: str) -> dict:
         """Get a document by ID."""
         self._load_from_db()
-        for doc in self.documents:
-            if doc["id"] == doc_id:
-                return doc
-        return None
+        with self._lock:
+            index = self._id_to_index.get(doc_id)
+            return self._document_dict(index) if index is not None else None
     
     def get_all_documents(self) -> list:
         """Get all documents."""
         self._load_from_db()
-        return self.documents
+        with self._lock:
+            return [self._document_dict(i) for i in range(len(self.doc_ids))]
+    
+    def get_document_previews(self) -> tuple:
+        """
+        (etag, [{"doc_id", "preview"}]) for all references, rebuilt only after
+        the references change. The ETag hashes the listing itself, so workers
+        holding the same documents agree on it.
+        """
+        from app.core.models import preview_text
+        
+        self._load_from_db()
+        generation = self._cache_generation
+        cached = self._previews_cache
+        if cached is not None and cached[0] == generation:
+            return cached[1], cached[2]
+        
+        with self._lock:
+            generation = self._cache_generation
+            previews = [
+                {"doc_id": doc_id, "preview": preview_text(text)}
+                for doc_id, text in zip(self.doc_ids, self.doc_texts)
+            ]
+        digest = hashlib.blake2b(digest_size=16)
+        for preview in previews:
+            digest.update(f"{preview['doc_id']}\0{preview['preview']}\0".encode("utf-8"))
+        etag = f'"{digest.hexdigest()}"'
+        self._previews_cache = (generation, etag, previews)
+        return etag, previews
+    
+    def get_document_count(self) -> int:
+        """Get the number of reference documents."""
+        self._load_from_db()
+        return len(self.doc_ids)
     
     def document_exists(self, doc_id: str) -> bool:
         """Check if a document exists."""
         self._load_from_db()
-        return any(doc["id"] == doc_id for doc in self.documents)
+        return doc_id in self._id_to_index
 
     def detect(self, text: str, threshold: float = 0.4):
         """
@@ -182,54 +706,115 @@ class PlagiarismDetector:
         Returns the top matches and a max score.
         Supports cross-language detection with 50+ languages.
         """
+        return self.detect_many([text], threshold)[0]
+    
+    def detect_many(self, texts: list, threshold: float = 0.4) -> list:
+        """
+        Runs detect() on several texts, encoding all uncached ones in one
+        batched call. Returns one result per text, in order.
+        """
         self._load_from_db()  # Ensure DB is loaded
         
-        # Detect query language
-        query_language = detect_language(text)
+        # Exact repeats of recent queries skip encoding and search entirely
+        results = [None] * len(texts)
+        misses = []  # (position, cache key)
+        with self._cache_lock:
+            for pos, text in enumerate(texts):
+                cache_key = (hashlib.sha256(text.encode("utf-8")).hexdigest(), threshold)
+                cached = self._query_cache.get(cache_key)
+                if cached is not None:
+                    self._query_cache.move_to_end(cache_key)
+                    results[pos] = dict(cached)
+                else:
+                    misses.append((pos, cache_key))
+            generation = self._cache_generation
+        if not misses:
+            return results
+        miss_texts = [texts[pos] for pos, _ in misses]
         
-        if self.embeddings is None or len(self.documents) == 0:
-            return {
-                "max_score": 0.0, 
-                "matches": [], 
-                "stylometry": stylometer.analyze(text),
-                "query_language": query_language,
-                "cross_language_enabled": True
-            }
-            
-        # Encode query
-        query_embedding = self.model.encode(text, convert_to_tensor=True)
+        # Stylometric analysis runs while the queries are encoded and searched
+        style_futures = [self._stylometry_pool.submit(stylometer.analyze, text) for text in miss_texts]
         
-        # Compute cosine similarity
-        scores = util.cos_sim(query_embedding, self.embeddings)[0]
+        # Detect query languages
+        query_languages = [detect_language(text) for text in miss_texts]
         
-        # Find matches above threshold
-        results = []
-        cross_language_matches = 0
-        for i, score in enumerate(scores):
-            score_val = float(score)
-            if score_val > threshold:
-                doc = self.documents[i]
-                doc_language = doc.get("language", {"code": "unknown", "name": "Unknown"})
+        if self.embeddings is None or len(self.doc_ids) == 0:
+            for (pos, _), style_future, query_language in zip(misses, style_futures, query_languages):
+                results[pos] = {
+                    "max_score": 0.0, 
+                    "matches": [], 
+                    "stylometry": style_future.result(),
+                    "query_language": query_language,
+                    "cross_language_enabled": True
+                }
+            return results
+            
+        # Encode unit-norm queries on the same device as the reference matrix
+        query_embeddings = self._encode(
+            miss_texts,
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_tensor=True,
+            device=self.device,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        
+        for (pos, cache_key), query_embedding, style_future, query_language in zip(
+            misses, query_embeddings, style_futures, query_languages
+        ):
+            result = self._detection_result(query_embedding, query_language, style_future, threshold, generation)
+            
+            # Skip caching if the references changed while this query was running
+            with self._cache_lock:
+                if generation == self._cache_generation:
+                    self._query_cache[cache_key] = result
+                    if len(self._query_cache) > QUERY_CACHE_SIZE:
+                        self._query_cache.popitem(last=False)
+            results[pos] = dict(result)
+        return results
+    
+    def _detection_result(self, query_embedding, query_language, style_future, threshold, generation):
+        """Build the detect() result for one encoded query."""
+        with self._lock:
+            # Compute cosine similarity (HNSW index for large reference sets);
+            # matches come back filtered and sorted by score descending.
+            # A near-identical recent query only supplies candidate positions,
+            # which are rescored against this query so scores are its own
+            if self.embeddings is None:
+                top_matches = []  # References cleared after the caller checked
+            else:
+                candidate_ids = self._similar_query_candidates(query_embedding, threshold)
+                if candidate_ids is not None:
+                    top_matches = self._rescore_matches(candidate_ids, query_embedding, threshold)
+                else:
+                    top_matches = self._top_matches(query_embedding, threshold)
+                    with self._cache_lock:
+                        if generation == self._cache_generation:
+                            self._recent_queries.append(
+                                (query_embedding, threshold, [i for i, _ in top_matches])
+                            )
+            
+            results = []
+            cross_language_matches = 0
+            for i, score_val in top_matches:
+                doc_language = self.doc_langs[i] or {"code": "unknown", "name": "Unknown"}
                 is_cross_language = doc_language.get("code") != query_language.get("code")
                 
                 if is_cross_language:
                     cross_language_matches += 1
                 
                 results.append({
-                    "doc_id": doc["id"],
+                    "doc_id": self.doc_ids[i],
                     "score": round(score_val * 100, 2),
-                    "snippet": doc["text"][:200] + "...",
+                    "snippet": self.doc_texts[i][:200] + "...",
                     "language": doc_language,
                     "is_cross_language": is_cross_language
                 })
         
-        # Sort by score descending
-        results.sort(key=lambda x: x['score'], reverse=True)
-        
         max_score = results[0]['score'] if results else 0.0
         
         # Stylometric Analysis
-        style_metrics = stylometer.analyze(text)
+        style_metrics = style_future.result()
 
         return {
             "max_score": max_score,
@@ -244,8 +829,17 @@ class PlagiarismDetector:
     
     def store_user_document(self, user_email: str, doc_id: str, text: str) -> dict:
         """Store a document uploaded by a user for cross-user detection."""
+        return self.store_user_documents(user_email, [(doc_id, text)])[0]
+    
+    def store_user_documents(self, user_email: str, pairs: list) -> list:
+        """
+        Store many (doc_id, text) documents for one user: one duplicate check,
+        one batched encode and one executemany INSERT. Returns a result dict
+        per pair, in order.
+        """
         from app.core.models import User, UserDocument
         from app.core.language_utils import detect_language
+        from sqlalchemy import insert
         
         db = self._get_db()
         try:
@@ -257,40 +851,149 @@ class PlagiarismDetector:
                 db.commit()
                 db.refresh(user)
             
-            # Check if document already exists for this user
-            existing = db.query(UserDocument).filter(
+            # Check which documents already exist for this user (or repeat in the batch)
+            seen = {doc_id for (doc_id,) in db.query(UserDocument.doc_id).filter(
                 UserDocument.user_id == user.id,
-                UserDocument.doc_id == doc_id
-            ).first()
+                UserDocument.doc_id.in_([doc_id for doc_id, _ in pairs])
+            )}
+            results = []
+            new_docs = []
+            for doc_id, text in pairs:
+                if doc_id in seen:
+                    results.append({"status": "exists", "doc_id": doc_id, "message": "Document already exists"})
+                    continue
+                seen.add(doc_id)
+                results.append(None)  # Filled in once stored
+                new_docs.append((len(results) - 1, doc_id, text))
             
-            if existing:
-                return {"status": "exists", "doc_id": doc_id, "message": "Document already exists"}
-            
-            # Detect language and create embedding
-            lang_info = detect_language(text)
-            embedding = self.model.encode(text, convert_to_tensor=True)
-            embedding_bytes = pickle.dumps(embedding.cpu())
-            
-            # Store document
-            user_doc = UserDocument(
-                user_id=user.id,
-                doc_id=doc_id,
-                text=text,
-                embedding=embedding_bytes,
-                language_code=lang_info.get("code", "unknown")
+            if not new_docs:
+                return results
+            
+            # Detect languages and create embeddings in one batched call
+            texts = [text for _, _, text in new_docs]
+            lang_infos = [detect_language(text) for text in texts]
+            embeddings = self._encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_tensor=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
             )
-            db.add(user_doc)
+            
+            # Store documents
+            db.execute(insert(UserDocument), [
+                {
+                    "user_id": user.id,
+                    "doc_id": doc_id,
+                    "text": text,
+                    "embedding": serialize_embedding(embedding),
+                    "model_version": self.model_version,
+                    "language_code": lang_info.get("code", "unknown")
+                }
+                for (_, doc_id, text), embedding, lang_info in zip(new_docs, embeddings, lang_infos)
+            ])
             db.commit()
+            self._cross_user_cache = None
             
-            return {
-                "status": "stored",
-                "doc_id": doc_id,
-                "language": lang_info,
-                "user_email": user_email
-            }
+            for (pos, doc_id, _), lang_info in zip(new_docs, lang_infos):
+                results[pos] = {
+                    "status": "stored",
+                    "doc_id": doc_id,
+                    "language": lang_info,
+                    "user_email": user_email
+                }
+            return results
         finally:
             db.close()
     
+    def _user_documents_version(self, db) -> tuple:
+        """
+        Cheap change marker for the user_documents table. Ids only grow, so
+        (row count, max id) changes on every insert or delete, including
+        those made by other workers.
+        """
+        from sqlalchemy import func
+        from app.core.models import UserDocument
+        
+        return tuple(db.query(func.count(UserDocument.id), func.max(UserDocument.id)).one())
+    
+    def _cross_user_index(self, db):
+        """
+        Return (matrix, owner ids, rows) for all user documents, reusing the
+        cached stack while the table is unchanged. The matrix is L2-normalized
+        on self.device; owner ids is a tensor aligned with its rows.
+        """
+        from app.core.models import User, UserDocument
+        
+        version = self._user_documents_version(db)
+        with self._cross_user_lock:
+            cached = self._cross_user_cache
+            if cached is not None and cached[0] == version:
+                return cached[1:]
+            
+            # Stream every document, decoding raw float16 blobs straight into
+            # one preallocated (M, D) matrix. Text is only fetched for stale rows
+            candidates = db.query(
+                UserDocument.id,
+                UserDocument.user_id,
+                UserDocument.doc_id,
+                UserDocument.embedding,
+                UserDocument.model_version,
+                UserDocument.language_code,
+                User.email,
+            ).outerjoin(User, UserDocument.user_id == User.id)
+            
+            dim = self.model.get_sentence_embedding_dimension()
+            matrix = np.empty((version[0], dim), dtype=np.float32)
+            rows = []
+            stale = []
+            for doc in candidates.yield_per(LOAD_BATCH_SIZE):
+                pos = len(rows)
+                matrix = _ensure_rows(matrix, pos + 1)
+                rows.append(_UserDocRow(doc.id, doc.user_id, doc.doc_id, doc.language_code, doc.email))
+                # Only trust stored embeddings produced by the current model
+                stored = None
+                if doc.model_version == self.model_version:
+                    stored = deserialize_embedding(doc.embedding, dim)
+                if stored is None:
+                    stale.append(pos)
+                else:
+                    matrix[pos] = stored
+            matrix = matrix[:len(rows)]
+            
+            if stale:
+                # Missing, legacy pickled or other-model embeddings: regenerate
+                # in one batched encode and write back in the raw float16 format
+                stale_texts = dict(db.query(UserDocument.id, UserDocument.text).filter(
+                    UserDocument.id.in_([rows[pos].id for pos in stale])
+                ).all())
+                matrix[stale] = self._encode(
+                    [stale_texts[rows[pos].id] for pos in stale],
+                    batch_size=ENCODE_BATCH_SIZE,
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+                try:
+                    db.bulk_update_mappings(UserDocument, [
+                        {
+                            "id": rows[pos].id,
+                            "embedding": matrix[pos].astype(EMBEDDING_DTYPE).tobytes(),
+                            "model_version": self.model_version
+                        }
+                        for pos in stale
+                    ])
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    print(f"Warning: Could not store re-embedded user documents: {e}")
+            
+            # Upcast happened on decode; similarity runs in float32
+            matrix = F.normalize(torch.from_numpy(matrix).to(self.device), dim=1)
+            owner_ids = torch.tensor([row.user_id for row in rows], dtype=torch.long, device=self.device)
+            
+            self._cross_user_cache = (version, matrix, owner_ids, rows)
+            return matrix, owner_ids, rows
+    
     def detect_cross_user(self, text: str, exclude_user_email: str, threshold: float = 0.4) -> dict:
         """Detect plagiarism against all users' documents except the specified user."""
         from app.core.models import User, UserDocument
@@ -305,12 +1008,11 @@ class PlagiarismDetector:
             exclude_user = db.query(User).filter(User.email == exclude_user_email).first()
             exclude_user_id = exclude_user.id if exclude_user else -1
             
-            # Query all documents except the current user's
-            other_docs = db.query(UserDocument).filter(
-                UserDocument.user_id != exclude_user_id
-            ).all()
+            matrix, owner_ids, rows = self._cross_user_index(db)
+            others = owner_ids != exclude_user_id
+            documents_checked = int(others.sum())
             
-            if not other_docs:
+            if documents_checked == 0:
                 return {
                     "max_score": 0.0,
                     "matches": [],
@@ -320,42 +1022,45 @@ class PlagiarismDetector:
                     "cross_user_detection": True
                 }
             
-            # Encode query
-            query_embedding = self.model.encode(text, convert_to_tensor=True)
+            # Encode a unit-norm query so similarity is a plain dot product
+            query_embedding = self._encode(
+                text, convert_to_tensor=True, device=self.device, normalize_embeddings=True
+            )
+            
+            # Single batched matmul; the excluded user's documents can never
+            # pass the threshold. Then vectorized threshold + top-k
+            scores = (matrix @ query_embedding).masked_fill(~others, float("-inf"))
+            if scores.is_cuda:
+                top_ids, top_scores = filter_top_k_tensor(scores, threshold, MAX_MATCHES)
+            else:
+                top_ids, top_scores = filter_top_k(scores.numpy(), threshold, MAX_MATCHES)
+            
+            matched = [rows[int(i)] for i in top_ids]
+            matched_texts = dict(db.query(UserDocument.id, UserDocument.text).filter(
+                UserDocument.id.in_([doc.id for doc in matched])
+            ).all()) if matched else {}
             
-            # Compare against each document
             results = []
             cross_language_matches = 0
             
-            for doc in other_docs:
-                # Load embedding
-                if doc.embedding:
-                    doc_embedding = pickle.loads(doc.embedding)
-                else:
-                    # Regenerate if missing
-                    doc_embedding = self.model.encode(doc.text, convert_to_tensor=True)
+            for doc, score in zip(matched, top_scores):
+                doc_text = matched_texts.get(doc.id)
+                if doc_text is None:
+                    continue  # Deleted since the matrix was cached
+                doc_language = {"code": doc.language_code or "unknown", "name": doc.language_code or "Unknown"}
+                is_cross_language = doc_language.get("code") != query_language.get("code")
                 
-                # Compute similarity
-                score = float(util.cos_sim(query_embedding, doc_embedding)[0][0])
+                if is_cross_language:
+                    cross_language_matches += 1
                 
-                if score > threshold:
-                    doc_language = {"code": doc.language_code or "unknown", "name": doc.language_code or "Unknown"}
-                    is_cross_language = doc_language.get("code") != query_language.get("code")
-                    
-                    if is_cross_language:
-                        cross_language_matches += 1
-                    
-                    results.append({
-                        "doc_id": doc.doc_id,
-                        "score": round(score * 100, 2),
-                        "snippet": doc.text[:200] + "..." if len(doc.text) > 200 else doc.text,
-                        "owner_email": doc.user.email if doc.user else "Unknown",
-                        "language": doc_language,
-                        "is_cross_language": is_cross_language
-                    })
-            
-            # Sort by score descending
-            results.sort(key=lambda x: x['score'], reverse=True)
+                results.append({
+                    "doc_id": doc.doc_id,
+                    "score": round(float(score) * 100, 2),
+                    "snippet": doc_text[:200] + "..." if len(doc_text) > 200 else doc_text,
+                    "owner_email": doc.email or "Unknown",
+                    "language": doc_language,
+                    "is_cross_language": is_cross_language
+                })
             
             max_score = results[0]['score'] if results else 0.0
             
@@ -369,7 +1074,7 @@ class PlagiarismDetector:
                 "query_language": query_language,
                 "cross_language_enabled": True,
                 "cross_language_matches": cross_language_matches,
-                "total_documents_checked": len(other_docs),
+                "total_documents_checked": documents_checked,
                 "cross_user_detection": True
             }
         finally:
@@ -377,7 +1082,7 @@ class PlagiarismDetector:
     
     def get_user_documents(self, user_email: str) -> list:
         """Get all documents uploaded by a specific user."""
-        from app.core.models import User, UserDocument
+        from app.core.models import User, UserDocument, preview_column, preview_text
         
         db = self._get_db()
         try:
@@ -385,8 +1090,22 @@ class PlagiarismDetector:
             if not user:
                 return []
             
-            docs = db.query(UserDocument).filter(UserDocument.user_id == user.id).all()
-            return [doc.to_dict() for doc in docs]
+            # Select only the preview prefix of each text instead of the full column
+            docs = db.query(
+                UserDocument.id,
+                UserDocument.doc_id,
+                preview_column(UserDocument.text).label("preview"),
+                UserDocument.language_code,
+                UserDocument.created_at
+            ).filter(UserDocument.user_id == user.id).all()
+            return [{
+                "id": doc.id,
+                "doc_id": doc.doc_id,
+                "user_email": user.email,
+                "preview": preview_text(doc.preview),
+                "language_code": doc.language_code,
+                "created_at": doc.created_at.isoformat() if doc.created_at else None
+            } for doc in docs]
         finally:
             db.close()
     
@@ -410,10 +1129,23 @@ class PlagiarismDetector:
             
             db.delete(doc)
             db.commit()
+            self._cross_user_cache = None
             return True
         finally:
             db.close()
     
+    def count_user_documents(self, user_email: str) -> int:
+        """Count the documents uploaded by a specific user."""
+        from app.core.models import User, UserDocument
+        
+        db = self._get_db()
+        try:
+            return db.query(UserDocument).join(User, UserDocument.user_id == User.id).filter(
+                User.email == user_email
+            ).count()
+        finally:
+            db.close()
+    
     def get_all_user_documents_count(self) -> int:
         """Get total count of all user documents in the system."""
         from app.core.models import UserDocument
@@ -425,5 +1157,7 @@ class PlagiarismDetector:
             db.close()
 
 
-# Global instance
-detector = PlagiarismDetector()
+@functools.lru_cache(maxsize=1)
+def get_detector() -> PlagiarismDetector:
+    """Shared detector instance, created on first use instead of at import."""
+    return PlagiarismDetector()
@@ -3,10 +3,20 @@ Feedback Manager for Self-Learning Feedback Loop.
 Handles storing user feedback and calculating threshold adjustments.
 """
 import hashlib
+import threading
+import time
 from datetime import datetime
 from typing import Optional, Dict, List
 from app.core.database import SessionLocal
 
+# Running feedback counts are resynced from the database (one GROUP BY) after
+# this many local submits or seconds, to pick up other workers' feedback
+FEEDBACK_RESYNC_SUBMITS = 100
+FEEDBACK_RESYNC_SECONDS = 60.0
+
+# Recorded with each feedback row next to the digest it names
+TEXT_HASH_ALGORITHM = "blake2b-128"
+
 
 class FeedbackManager:
     """Manages feedback collection and adaptive threshold calculations."""
@@ -14,14 +24,20 @@ class FeedbackManager:
     def __init__(self):
         self._threshold_adjustment = 0.0  # Adjustment value for detection threshold
         self._min_feedback_for_adjustment = 10  # Minimum feedback entries before adjusting
+        # Running counts per feedback type: loaded by one GROUP BY, then bumped
+        # in O(1) per submit and resynced every FEEDBACK_RESYNC_SUBMITS/SECONDS
+        self._type_counts: Dict[str, int] = {}
+        self._counts_synced_at = None  # time.monotonic() of the last resync
+        self._submits_since_sync = 0
+        self._counts_lock = threading.Lock()
     
     def _get_db(self):
         """Get database session."""
         return SessionLocal()
     
-    def _hash_text(self, text: str) -> str:
-        """Create a hash of the submitted text for tracking."""
-        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    def _hash_text(self, text: str) -> bytes:
+        """Create a 128-bit BLAKE2b hash of the submitted text for tracking."""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
     
     def submit_feedback(
         self,
@@ -76,6 +92,7 @@ class FeedbackManager:
                 user_id=user_id,
                 doc_id=doc_id,
                 submitted_text_hash=self._hash_text(submitted_text),
+                text_hash_algorithm=TEXT_HASH_ALGORITHM,
                 match_score=int(match_score),
                 feedback_type=feedback_type,
                 severity=severity,
@@ -89,7 +106,7 @@ class FeedbackManager:
             db.refresh(feedback)
             
             # Recalculate threshold adjustment
-            self._update_threshold_adjustment(db)
+            self._update_threshold_adjustment(db, feedback_type)
             
             return {
                 "id": feedback.id,
@@ -101,7 +118,50 @@ class FeedbackManager:
         finally:
             db.close()
     
-    def _update_threshold_adjustment(self, db):
+    def _type_summary(self, db) -> Dict[str, tuple]:
+        """Count and average match score per feedback type, in one GROUP BY query."""
+        from app.core.models import Feedback
+        from sqlalchemy import func
+        
+        rows = db.query(
+            Feedback.feedback_type,
+            func.count(Feedback.id),
+            func.avg(Feedback.match_score)
+        ).group_by(Feedback.feedback_type).all()
+        
+        return {feedback_type: (count, avg or 0) for feedback_type, count, avg in rows}
+    
+    def _count_feedback(self, db, feedback_type: str) -> Dict[str, int]:
+        """
+        Add one just-committed feedback row to the running counts and return
+        a snapshot of them. The counts are rebuilt with one GROUP BY on first
+        use and after FEEDBACK_RESYNC_SUBMITS submits or FEEDBACK_RESYNC_SECONDS,
+        which also picks up feedback written by other workers.
+        """
+        from app.core.models import Feedback
+        from sqlalchemy import func
+        
+        with self._counts_lock:
+            now = time.monotonic()
+            if (
+                self._counts_synced_at is None
+                or self._submits_since_sync >= FEEDBACK_RESYNC_SUBMITS
+                or now - self._counts_synced_at >= FEEDBACK_RESYNC_SECONDS
+            ):
+                # The recount already includes the row being counted
+                rows = db.query(
+                    Feedback.feedback_type,
+                    func.count(Feedback.id)
+                ).group_by(Feedback.feedback_type).all()
+                self._type_counts = {row_type: count for row_type, count in rows}
+                self._counts_synced_at = now
+                self._submits_since_sync = 0
+            else:
+                self._type_counts[feedback_type] = self._type_counts.get(feedback_type, 0) + 1
+                self._submits_since_sync += 1
+            return dict(self._type_counts)
+    
+    def _update_threshold_adjustment(self, db, feedback_type: str):
         """
         Calculate threshold adjustment based on accumulated feedback.
         
@@ -109,24 +169,15 @@ class FeedbackManager:
         - If many false positives at low scores: lower the threshold
         - If many confirmed plagiarism at high scores: raise the threshold
         """
-        from app.core.models import Feedback
-        from sqlalchemy import func
-        
-        # Get feedback counts
-        total = db.query(Feedback).count()
+        type_counts = self._count_feedback(db, feedback_type)
+        total = sum(type_counts.values())
         
         if total < self._min_feedback_for_adjustment:
             self._threshold_adjustment = 0.0
             return
         
         # Calculate false positive rate for different score ranges
-        false_positives = db.query(Feedback).filter(
-            Feedback.feedback_type == 'false_positive'
-        ).count()
-        
-        confirmed = db.query(Feedback).filter(
-            Feedback.feedback_type == 'confirmed'
-        ).count()
+        false_positives = type_counts.get('false_positive', 0)
         
         if total > 0:
             fp_rate = false_positives / total
@@ -138,35 +189,21 @@ class FeedbackManager:
     
     def get_stats(self) -> Dict:
         """Get feedback statistics."""
-        from app.core.models import Feedback
-        from sqlalchemy import func
-        
         db = self._get_db()
         try:
-            total = db.query(Feedback).count()
-            false_positives = db.query(Feedback).filter(
-                Feedback.feedback_type == 'false_positive'
-            ).count()
-            confirmed = db.query(Feedback).filter(
-                Feedback.feedback_type == 'confirmed'
-            ).count()
-            
-            # Average scores by feedback type
-            fp_avg_score = db.query(func.avg(Feedback.match_score)).filter(
-                Feedback.feedback_type == 'false_positive'
-            ).scalar() or 0
-            
-            confirmed_avg_score = db.query(func.avg(Feedback.match_score)).filter(
-                Feedback.feedback_type == 'confirmed'
-            ).scalar() or 0
+            # Counts and average scores by feedback type
+            summary = self._type_summary(db)
+            total = sum(count for count, _ in summary.values())
+            false_positives, fp_avg_score = summary.get('false_positive', (0, 0))
+            confirmed, confirmed_avg_score = summary.get('confirmed', (0, 0))
             
             return {
                 "total_feedback": total,
                 "false_positives": false_positives,
                 "confirmed_plagiarism": confirmed,
                 "false_positive_rate": round(false_positives / total * 100, 1) if total > 0 else 0,
-                "avg_false_positive_score": round(fp_avg_score, 1),
-                "avg_confirmed_score": round(confirmed_avg_score, 1),
+                "avg_false_positive_score": round(float(fp_avg_score), 1),
+                "avg_confirmed_score": round(float(confirmed_avg_score), 1),
                 "threshold_adjustment": round(self._threshold_adjustment, 1),
                 "learning_active": total >= self._min_feedback_for_adjustment
             }
@@ -1,8 +1,16 @@
 """
 Language detection utilities for cross-language plagiarism detection.
 """
+import hashlib
+import threading
+from collections import OrderedDict
 from langdetect import detect, detect_langs, LangDetectException
 
+# Number of detect_language results kept, keyed by a digest of the full text
+LANGUAGE_CACHE_SIZE = 4096
+_language_cache = OrderedDict()
+_language_cache_lock = threading.Lock()  # detect_language runs in worker threads
+
 # Language code to name mapping
 LANGUAGE_NAMES = {
     "en": "English",
@@ -68,9 +76,24 @@ def detect_language(text: str) -> dict:
         if not text or len(text.strip()) < 10:
             return {"code": "unknown", "name": "Unknown (text too short)"}
         
+        # The same text is often checked repeatedly (upload, detect, cross-user);
+        # a 16-byte digest keeps the cache small without prefix collisions
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with _language_cache_lock:
+            cached = _language_cache.get(key)
+            if cached is not None:
+                _language_cache.move_to_end(key)
+                return dict(cached)
+        
         code = detect(text)
         name = LANGUAGE_NAMES.get(code, code.upper())
-        return {"code": code, "name": name}
+        result = {"code": code, "name": name}
+        
+        with _language_cache_lock:
+            _language_cache[key] = result
+            if len(_language_cache) > LANGUAGE_CACHE_SIZE:
+                _language_cache.popitem(last=False)
+        return dict(result)
     except LangDetectException:
         return {"code": "unknown", "name": "Unknown"}
 
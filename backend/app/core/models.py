@@ -1,11 +1,43 @@
 """
 SQLAlchemy ORM models for the database.
 """
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, LargeBinary, JSON, Float, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, LargeBinary, VARBINARY, JSON, Float, Boolean, Index
+from sqlalchemy import case, func, select, update
+from sqlalchemy.orm import deferred, relationship
 from datetime import datetime
 from app.core.database import Base
 
+# Activity types counted as text checks / file checks in user statistics
+TEXT_CHECK_TYPES = ("text_check", "cross_user_check")
+FILE_CHECK_TYPES = ("file_check", "cross_user_file_check")
+
+# get_stats() key -> denormalized User column kept current by the activity writer
+STATS_COLUMNS = {
+    "total_activities": "activities_count",
+    "text_checks": "text_checks_count",
+    "file_checks": "file_checks_count",
+    "references_added": "refs_added_sum",
+    "references_deleted": "refs_deleted_count",
+    "total_files_analyzed": "files_analyzed_sum",
+    "highest_plagiarism_score": "highest_plagiarism_score",
+}
+
+# Characters of document text shown in listing previews
+PREVIEW_CHARS = 100
+
+
+def preview_text(text: str) -> str:
+    """Shorten text to PREVIEW_CHARS for listings, marking the cut with '...'."""
+    return text[:PREVIEW_CHARS] + "..." if len(text) > PREVIEW_CHARS else text
+
+
+def preview_column(text_column):
+    """
+    SQL expression selecting just enough of text_column for preview_text().
+    One extra character tells whether the text was cut.
+    """
+    return func.substr(text_column, 1, PREVIEW_CHARS + 1)
+
 
 class User(Base):
     """User model for storing user information."""
@@ -17,25 +49,54 @@ class User(Base):
     role = Column(String(20), default='user')  # user/instructor/admin
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    # Relationship to activities
-    activities = relationship("Activity", back_populates="user", cascade="all, delete-orphan")
+    # Denormalized activity stats (see STATS_COLUMNS). New users start at 0;
+    # NULL marks rows that predate the columns and still need a backfill
+    activities_count = Column(Integer, default=0)
+    text_checks_count = Column(Integer, default=0)
+    file_checks_count = Column(Integer, default=0)
+    refs_added_sum = Column(Integer, default=0)
+    refs_deleted_count = Column(Integer, default=0)
+    files_analyzed_sum = Column(Integer, default=0)
+    highest_plagiarism_score = Column(Float, default=0.0)
     
-    def to_dict(self, include_activities=False):
-        data = {
-            "username": self.email,  # Keep 'username' key for frontend compatibility
-            "email": self.email,
-            "role": self.role or 'user',
-            "created_at": self.created_at.isoformat() if self.created_at else None,
-            "stats": self.get_stats()
-        }
+    # Relationship to activities, loaded newest first via ix_activities_user_created
+    activities = relationship(
+        "Activity", back_populates="user", cascade="all, delete-orphan",
+        order_by="Activity.created_at.desc()"
+    )
+    
+    def to_dict(self, include_activities=False, stats=None):
+        """Serialize the user; pass precomputed `stats` to avoid loading activities."""
+        data = self.row_to_dict(self, stats if stats is not None else (self.stored_stats() or self.get_stats()))
         if include_activities:
-            data["activities"] = [a.to_dict() for a in sorted(self.activities, key=lambda x: x.created_at, reverse=True)]
+            data["activities"] = [a.to_dict() for a in self.activities]
         return data
     
-    def get_stats(self):
-        """Calculate user statistics from activities."""
-        stats = {
-            "total_activities": len(self.activities),
+    @staticmethod
+    def row_to_dict(row, stats):
+        """
+        to_dict() fields from anything with the user's email, role and
+        created_at: an ORM instance or a plain row from list_columns().
+        """
+        return {
+            "username": row.email,  # Keep 'username' key for frontend compatibility
+            "email": row.email,
+            "role": row.role or 'user',
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "stats": stats
+        }
+    
+    @classmethod
+    def list_columns(cls):
+        """Columns needed for row_to_dict() and stats_from_columns(), without hydrating Users."""
+        return [cls.id, cls.email, cls.role, cls.created_at] + [
+            getattr(cls, column) for column in STATS_COLUMNS.values()
+        ]
+    
+    @staticmethod
+    def empty_stats():
+        return {
+            "total_activities": 0,
             "text_checks": 0,
             "file_checks": 0,
             "references_added": 0,
@@ -43,26 +104,127 @@ class User(Base):
             "total_files_analyzed": 0,
             "highest_plagiarism_score": 0.0
         }
-        
+    
+    @staticmethod
+    def accumulate_stats(stats, activity_type, details):
+        """Fold one activity into a get_stats() dict."""
+        details = details or {}
+        stats["total_activities"] += 1
+        if activity_type in TEXT_CHECK_TYPES:
+            stats["text_checks"] += 1
+            score = details.get("max_score", 0)
+            if score > stats["highest_plagiarism_score"]:
+                stats["highest_plagiarism_score"] = score
+        elif activity_type in FILE_CHECK_TYPES:
+            stats["file_checks"] += 1
+            stats["total_files_analyzed"] += details.get("file_count", 0)
+            score = details.get("max_score", 0)
+            if score > stats["highest_plagiarism_score"]:
+                stats["highest_plagiarism_score"] = score
+        elif activity_type == "reference_add":
+            stats["references_added"] += details.get("count", 0)
+        elif activity_type == "reference_delete":
+            stats["references_deleted"] += 1
+    
+    def get_stats(self):
+        """Calculate user statistics from activities."""
+        stats = self.empty_stats()
         for activity in self.activities:
-            details = activity.details or {}
-            if activity.activity_type in ("text_check", "cross_user_check"):
-                stats["text_checks"] += 1
-                score = details.get("max_score", 0)
-                if score > stats["highest_plagiarism_score"]:
-                    stats["highest_plagiarism_score"] = score
-            elif activity.activity_type in ("file_check", "cross_user_file_check"):
-                stats["file_checks"] += 1
-                stats["total_files_analyzed"] += details.get("file_count", 0)
-                score = details.get("max_score", 0)
-                if score > stats["highest_plagiarism_score"]:
-                    stats["highest_plagiarism_score"] = score
-            elif activity.activity_type == "reference_add":
-                stats["references_added"] += details.get("count", 0)
-            elif activity.activity_type == "reference_delete":
-                stats["references_deleted"] += 1
-        
+            self.accumulate_stats(stats, activity.activity_type, activity.details)
         return stats
+    
+    def stored_stats(self):
+        """Stats from the denormalized columns, or None if not backfilled yet."""
+        return self.stats_from_columns(self)
+    
+    @staticmethod
+    def stats_from_columns(row):
+        """stored_stats() for an ORM instance or a row from list_columns()."""
+        values = {key: getattr(row, column) for key, column in STATS_COLUMNS.items()}
+        if any(value is None for value in values.values()):
+            return None
+        values["highest_plagiarism_score"] = float(values["highest_plagiarism_score"])
+        return values
+    
+    @classmethod
+    def increment_stats(cls, user_id: int, delta: dict):
+        """UPDATE adding a batch's stats (an accumulate_stats() dict) to the user's columns."""
+        values = {}
+        for key, column_name in STATS_COLUMNS.items():
+            column = getattr(cls, column_name)
+            if key == "highest_plagiarism_score":
+                values[column_name] = func.greatest(column, delta[key])
+            else:
+                values[column_name] = column + delta[key]
+        return update(cls).where(cls.id == user_id).values(**values)
+    
+    @classmethod
+    def backfill_stats(cls, db):
+        """
+        Fill stats columns still NULL from the activity log. One UPDATE with a
+        correlated subquery per column, so each row is computed and written
+        atomically with respect to concurrent increments.
+        """
+        values = {
+            STATS_COLUMNS[aggregate.name]: func.coalesce(
+                select(aggregate).where(Activity.user_id == cls.id).scalar_subquery(), 0
+            )
+            for aggregate in cls.stats_aggregates()
+        }
+        db.execute(update(cls).where(cls.activities_count.is_(None)).values(**values))
+        db.commit()
+    
+    @staticmethod
+    def stats_aggregates():
+        """Labeled SQL aggregates over Activity matching get_stats()."""
+        score = Activity.details["max_score"].as_float()
+        is_text = Activity.activity_type.in_(TEXT_CHECK_TYPES)
+        is_file = Activity.activity_type.in_(FILE_CHECK_TYPES)
+        return [
+            func.count(Activity.id).label("total_activities"),
+            func.sum(case((is_text, 1), else_=0)).label("text_checks"),
+            func.sum(case((is_file, 1), else_=0)).label("file_checks"),
+            func.sum(case(
+                (Activity.activity_type == "reference_add", Activity.details["count"].as_integer()), else_=0
+            )).label("references_added"),
+            func.sum(case((Activity.activity_type == "reference_delete", 1), else_=0)).label("references_deleted"),
+            func.sum(case((is_file, Activity.details["file_count"].as_integer()), else_=0)).label("total_files_analyzed"),
+            func.max(case((is_text | is_file, score))).label("highest_plagiarism_score"),
+        ]
+    
+    @staticmethod
+    def stats_from_row(row):
+        """Build the get_stats() dict from a row of stats_aggregates() columns (NULL-safe)."""
+        return {
+            "total_activities": int(row.total_activities or 0),
+            "text_checks": int(row.text_checks or 0),
+            "file_checks": int(row.file_checks or 0),
+            "references_added": int(row.references_added or 0),
+            "references_deleted": int(row.references_deleted or 0),
+            "total_files_analyzed": int(row.total_files_analyzed or 0),
+            "highest_plagiarism_score": max(float(row.highest_plagiarism_score or 0), 0.0)
+        }
+    
+    @classmethod
+    def get_stats_sql(cls, db, user_id: int):
+        """Same result as get_stats(), computed by one aggregate query."""
+        row = db.execute(
+            select(*cls.stats_aggregates()).where(Activity.user_id == user_id)
+        ).one()
+        return cls.stats_from_row(row)
+    
+    @classmethod
+    def get_stats_sql_many(cls, db, user_ids):
+        """get_stats_sql() for many users in one grouped outer-join query: user id -> stats."""
+        if not user_ids:
+            return {}
+        rows = db.execute(
+            select(cls.id, *cls.stats_aggregates())
+            .outerjoin(Activity, Activity.user_id == cls.id)
+            .where(cls.id.in_(user_ids))
+            .group_by(cls.id)
+        ).all()
+        return {row.id: cls.stats_from_row(row) for row in rows}
 
 
 class Activity(Base):
@@ -75,6 +237,11 @@ class Activity(Base):
     details = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # Newest-first activity feed per user: index range scan that stops at LIMIT
+        Index("ix_activities_user_created", user_id, created_at.desc()),
+    )
+    
     # Relationship to user
     user = relationship("User", back_populates="activities")
     
@@ -92,15 +259,18 @@ class ReferenceDocument(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     doc_id = Column(String(255), unique=True, nullable=False, index=True)
-    text = Column(Text, nullable=False)
-    embedding = Column(LargeBinary, nullable=True)  # Serialized tensor
+    text = deferred(Column(Text, nullable=False))  # Loaded on first access
+    embedding = Column(LargeBinary, nullable=True)  # Raw float16 embedding bytes
+    model_version = Column(String(32), nullable=True)  # Model that produced the embedding
+    language_code = Column(String(8), nullable=True)  # Detected language, cached on insert
+    language_name = Column(String(64), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     def to_dict(self):
         return {
             "doc_id": self.doc_id,
             "text": self.text,
-            "preview": self.text[:100] + "..." if len(self.text) > 100 else self.text,
+            "preview": preview_text(self.text),
             "created_at": self.created_at.isoformat() if self.created_at else None
         }
 
@@ -108,11 +278,19 @@ class ReferenceDocument(Base):
 class Feedback(Base):
     """Feedback model for storing user corrections on detection results."""
     __tablename__ = "feedback"
+    __table_args__ = (
+        # Covering indexes for the adaptive engine's grouped counts
+        Index("idx_fb_type_score", "feedback_type", "match_score"),
+        Index("idx_fb_layer_type", "detection_layer", "feedback_type"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     doc_id = Column(String(255), nullable=False, index=True)  # Reference document ID
-    submitted_text_hash = Column(String(64), nullable=False)  # SHA256 hash of submitted text
+    submitted_text_hash = Column(VARBINARY(32), nullable=False)  # Raw digest of submitted text
+    # Digest algorithm of submitted_text_hash: 'blake2b-128' (16 bytes) for new rows,
+    # 'sha256' (32 bytes) for rows converted from the legacy hex column
+    text_hash_algorithm = Column(String(16), nullable=True)
     match_score = Column(Integer, nullable=False)  # Original match score (0-100)
     feedback_type = Column(String(20), nullable=False)  # 'false_positive' or 'confirmed'
     
@@ -172,12 +350,17 @@ class LayerWeights(Base):
 class UserDocument(Base):
     """Model for storing user uploaded documents for cross-user plagiarism detection."""
     __tablename__ = "user_documents"
+    __table_args__ = (
+        # Per-user document lookups (duplicate check on upload, delete by doc_id)
+        Index("ix_userdoc_user_doc", "user_id", "doc_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     doc_id = Column(String(255), nullable=False, index=True)  # filename or identifier
-    text = Column(Text, nullable=False)
-    embedding = Column(LargeBinary, nullable=True)  # Serialized tensor
+    text = deferred(Column(Text, nullable=False))  # Loaded on first access
+    embedding = Column(LargeBinary, nullable=True)  # Raw float16 embedding bytes
+    model_version = Column(String(32), nullable=True)  # Model that produced the embedding
     language_code = Column(String(10), nullable=True)  # Detected language
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -189,7 +372,7 @@ class UserDocument(Base):
             "id": self.id,
             "doc_id": self.doc_id,
             "user_email": self.user.email if self.user else None,
-            "preview": self.text[:100] + "..." if len(self.text) > 100 else self.text,
+            "preview": preview_text(self.text),
             "language_code": self.language_code,
             "created_at": self.created_at.isoformat() if self.created_at else None
         }
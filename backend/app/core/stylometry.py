@@ -1,23 +1,11 @@
-import nltk
-from nltk.tokenize import sent_tokenize, word_tokenize
+import re
 import statistics
-import os
 
-# Ensure NLTK data path includes our local directory if needed, 
-# but usually it downloads to user home. 
-# We'll try to download quietly if not present.
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    print("Downloading NLTK punkt tokenizer...")
-    nltk.download('punkt', quiet=True)
-    print("Downloaded.")
-
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    print("Downloading NLTK punkt_tab tokenizer...")
-    nltk.download('punkt_tab', quiet=True)
+# Regex tokenization is enough for sentence-length and type-token statistics.
+# Sentence: text up to terminal punctuation (Latin or CJK) or the end of input
+_SENT_RE = re.compile(r"[^.!?。！？]+(?:[.!?。！？]+|$)")
+# Word: run of Unicode letters/digits, the same tokens isalnum() accepted
+_WORD_RE = re.compile(r"[^\W_]+")
 
 
 class StylometryAnalyzer:
@@ -30,18 +18,9 @@ class StylometryAnalyzer:
                 "total_words": 0
             }
 
-        try:
-            sentences = sent_tokenize(text)
-            words = word_tokenize(text)
-        except Exception as e:
-            print(f"Error in tokenization: {e}")
-            return {
-                "avg_sentence_length": 0,
-                "vocabulary_richness": 0,
-                "error": str(e)
-            }
+        sentences = [s for s in _SENT_RE.findall(text) if s.strip()]
         
-        if not sentences or not words:
+        if not sentences:
             return {
                 "avg_sentence_length": 0,
                 "vocabulary_richness": 0,
@@ -50,19 +29,18 @@ class StylometryAnalyzer:
             }
             
         # Average Sentence Length
-        # Filter mostly alphanumeric words for length calc
-        sent_lengths = []
-        for s in sentences:
-            s_words = [w for w in word_tokenize(s) if w.isalnum()]
-            if s_words:
-                sent_lengths.append(len(s_words))
+        # Words are tokenized per sentence once and reused for vocabulary below
+        words_per_sentence = [_WORD_RE.findall(s) for s in sentences]
+        sent_lengths = [len(s_words) for s_words in words_per_sentence if s_words]
         
         avg_sent_len = statistics.mean(sent_lengths) if sent_lengths else 0
         
         # Vocabulary Richness (Type-Token Ratio)
-        alphanum_words = [w.lower() for w in words if w.isalnum()]
-        unique_words = set(alphanum_words)
-        total_words = len(alphanum_words)
+        # Count tokens and distinct words in one pass, no flat word list
+        unique_words = set()
+        for s_words in words_per_sentence:
+            unique_words.update(w.lower() for w in s_words)
+        total_words = sum(sent_lengths)
         ttr = len(unique_words) / total_words if total_words > 0 else 0
         
         return {
@@ -1,8 +1,23 @@
 """
 User management with MySQL database storage, with in-memory fallback.
 """
+from contextlib import contextmanager
 from typing import Optional
 from datetime import datetime
+import queue
+import threading
+import time
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.core.auth import hash_password, verify_password
+from app.core.database import SessionLocal
+from app.core.models import Activity, User
+
+# Buffered activity rows are written in one INSERT per batch
+ACTIVITY_BATCH_SIZE = 200
+ACTIVITY_FLUSH_INTERVAL = 0.05  # Seconds a partial batch waits for more rows
+ACTIVITY_FLUSH_TIMEOUT = 5.0  # Longest a read waits for earlier activities to be written
 
 
 class ActivityInMemory:
@@ -26,10 +41,9 @@ class UserInMemory:
         self.email = email
         self.created_at = datetime.now().isoformat()
         self.activities = []
-    
-    def get_stats(self):
-        stats = {
-            "total_activities": len(self.activities),
+        # Running stats, updated as activities are added instead of recounted per read
+        self._stats = {
+            "total_activities": 0,
             "text_checks": 0,
             "file_checks": 0,
             "references_added": 0,
@@ -37,20 +51,26 @@ class UserInMemory:
             "total_files_analyzed": 0,
             "highest_plagiarism_score": 0.0
         }
-        for activity in self.activities:
-            if activity.type == "text_check":
-                stats["text_checks"] += 1
-                score = activity.details.get("max_score", 0)
-                if score > stats["highest_plagiarism_score"]:
-                    stats["highest_plagiarism_score"] = score
-            elif activity.type == "file_check":
-                stats["file_checks"] += 1
-                stats["total_files_analyzed"] += activity.details.get("file_count", 0)
-            elif activity.type == "reference_add":
-                stats["references_added"] += activity.details.get("count", 0)
-            elif activity.type == "reference_delete":
-                stats["references_deleted"] += 1
-        return stats
+    
+    def add_activity(self, activity: ActivityInMemory):
+        self.activities.append(activity)
+        stats = self._stats
+        stats["total_activities"] += 1
+        if activity.type == "text_check":
+            stats["text_checks"] += 1
+            score = activity.details.get("max_score", 0)
+            if score > stats["highest_plagiarism_score"]:
+                stats["highest_plagiarism_score"] = score
+        elif activity.type == "file_check":
+            stats["file_checks"] += 1
+            stats["total_files_analyzed"] += activity.details.get("file_count", 0)
+        elif activity.type == "reference_add":
+            stats["references_added"] += activity.details.get("count", 0)
+        elif activity.type == "reference_delete":
+            stats["references_deleted"] += 1
+    
+    def get_stats(self):
+        return dict(self._stats)
     
     def to_dict(self, include_activities=False):
         data = {
@@ -70,13 +90,16 @@ class UserManager:
     def __init__(self):
         self.use_database = False
         self.users_memory = {}  # In-memory fallback
+        self._user_ids = {}  # email -> user id, only used by the activity writer thread
+        self._activity_queue = queue.Queue()
+        self._activity_writer = None
+        self._writer_lock = threading.Lock()
+        self._stats_backfilled = False
         self._try_database()
     
     def _try_database(self):
         """Try to connect to database."""
         try:
-            from app.core.database import SessionLocal
-            from sqlalchemy import text
             db = SessionLocal()
             db.execute(text("SELECT 1"))
             db.close()
@@ -86,6 +109,34 @@ class UserManager:
             print(f"UserManager: MySQL unavailable, using in-memory storage. Error: {e}")
             self.use_database = False
     
+    @contextmanager
+    def _session(self, db: Optional[Session] = None):
+        """Use the caller's session if given, otherwise open and close a new one."""
+        if db is not None:
+            yield db
+            return
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+    
+    def _ensure_stats_backfilled(self, db):
+        """Fill stats columns of users that predate them, once per process."""
+        if self._stats_backfilled:
+            return
+        try:
+            User.backfill_stats(db)
+        except Exception as e:
+            db.rollback()
+            print(f"Warning: Could not backfill user stats: {e}")
+        self._stats_backfilled = True
+    
+    def _user_stats(self, db, user) -> dict:
+        """Stats from the user's stored counters; one aggregate query if still missing."""
+        stats = User.stats_from_columns(user)
+        return stats if stats is not None else User.get_stats_sql(db, user.id)
+    
     def get_or_create_user(self, email: str):
         """Get existing user or create new one."""
         if self.use_database:
@@ -96,12 +147,9 @@ class UserManager:
             return self.users_memory[email]
     
     def _db_get_or_create_user(self, email: str):
-        from app.core.database import SessionLocal
-        from app.core.models import User
-        from sqlalchemy.orm import joinedload
         db = SessionLocal()
         try:
-            user = db.query(User).options(joinedload(User.activities)).filter(User.email == email).first()
+            user = db.query(User).filter(User.email == email).first()
             if not user:
                 user = User(email=email)
                 db.add(user)
@@ -111,15 +159,10 @@ class UserManager:
         finally:
             db.close()
     
-    def register_user(self, email: str, password: str):
+    def register_user(self, email: str, password: str, db: Optional[Session] = None):
         """Register a new user with email and password. Returns (user_dict, error)."""
-        from app.core.auth import hash_password
-        
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            db = SessionLocal()
-            try:
+            with self._session(db) as db:
                 # Check if user already exists
                 existing = db.query(User).filter(User.email == email).first()
                 if existing:
@@ -133,8 +176,6 @@ class UserManager:
                 # Return dict while session is still open
                 user_dict = user.to_dict()
                 return user_dict, None
-            finally:
-                db.close()
         else:
             # In-memory fallback
             if email in self.users_memory:
@@ -144,28 +185,21 @@ class UserManager:
             self.users_memory[email] = user
             return user.to_dict(), None
     
-    def authenticate_user(self, email: str, password: str):
+    def authenticate_user(self, email: str, password: str, db: Optional[Session] = None):
         """Authenticate user with email and password. Returns (user_dict, error)."""
-        from app.core.auth import verify_password
-        
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            from sqlalchemy.orm import joinedload
-            db = SessionLocal()
-            try:
-                user = db.query(User).options(joinedload(User.activities)).filter(User.email == email).first()
+            with self._session(db) as db:
+                self._ensure_stats_backfilled(db)
+                user = db.query(User).filter(User.email == email).first()
                 if not user:
                     return None, "Invalid email or password"
                 if not user.password_hash:
                     return None, "Please register first - no password set for this account"
                 if not verify_password(password, user.password_hash):
                     return None, "Invalid email or password"
-                # Return dict while session is still open
-                user_dict = user.to_dict()
+                # Return dict while session is still open; stats from stored counters
+                user_dict = user.to_dict(stats=self._user_stats(db, user))
                 return user_dict, None
-            finally:
-                db.close()
         else:
             user = self.users_memory.get(email)
             if not user:
@@ -176,29 +210,19 @@ class UserManager:
                 return None, "Invalid email or password"
             return user.to_dict(), None
     
-    def check_user_exists(self, email: str) -> bool:
+    def check_user_exists(self, email: str, db: Optional[Session] = None) -> bool:
         """Check if a user with the given email exists."""
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            db = SessionLocal()
-            try:
+            with self._session(db) as db:
                 user = db.query(User).filter(User.email == email).first()
                 return user is not None
-            finally:
-                db.close()
         else:
             return email in self.users_memory
     
-    def reset_password(self, email: str, new_password: str) -> tuple:
+    def reset_password(self, email: str, new_password: str, db: Optional[Session] = None) -> tuple:
         """Reset user's password. Returns (success, error_message)."""
-        from app.core.auth import hash_password
-        
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            db = SessionLocal()
-            try:
+            with self._session(db) as db:
                 user = db.query(User).filter(User.email == email).first()
                 if not user:
                     return False, "User not found"
@@ -206,8 +230,6 @@ class UserManager:
                 user.password_hash = hash_password(new_password)
                 db.commit()
                 return True, None
-            finally:
-                db.close()
         else:
             user = self.users_memory.get(email)
             if not user:
@@ -215,17 +237,14 @@ class UserManager:
             user.password_hash = hash_password(new_password)
             return True, None
     
-    def get_user(self, email: str):
+    def get_user(self, email: str, db: Optional[Session] = None):
         """Get user by email."""
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            from sqlalchemy.orm import joinedload
-            db = SessionLocal()
-            try:
-                return db.query(User).options(joinedload(User.activities)).filter(User.email == email).first()
-            finally:
-                db.close()
+            self.flush_activities()
+            with self._session(db) as db:
+                # to_dict() reads the stored stats columns, so activities are not loaded
+                self._ensure_stats_backfilled(db)
+                return db.query(User).filter(User.email == email).first()
         else:
             return self.users_memory.get(email)
     
@@ -236,89 +255,207 @@ class UserManager:
         else:
             user = self.get_or_create_user(email)
             activity = ActivityInMemory(activity_type, details)
-            user.activities.append(activity)
+            user.add_activity(activity)
             return activity
     
+    def _resolve_user_ids(self, db, emails: set) -> dict:
+        """
+        Map emails to user ids, creating users that do not exist yet.
+        Runs in the activity writer thread, so requests never wait on it.
+        """
+        missing = emails - self._user_ids.keys()
+        if missing:
+            self._user_ids.update(db.execute(
+                select(User.email, User.id).where(User.email.in_(missing))
+            ).all())
+            created = missing - self._user_ids.keys()
+            for email in created:
+                try:
+                    db.execute(insert(User).values(email=email))
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()  # Created meanwhile by another worker
+            if created:
+                self._user_ids.update(db.execute(
+                    select(User.email, User.id).where(User.email.in_(created))
+                ).all())
+        return self._user_ids
+    
     def _db_log_activity(self, email: str, activity_type: str, details: dict = None):
-        from app.core.database import SessionLocal
-        from app.core.models import User, Activity
+        row = {
+            "email": email,  # Resolved to a user id by the writer thread
+            "activity_type": activity_type,
+            "details": details or {},
+            "created_at": datetime.utcnow()  # Time of the action, not of the batch write
+        }
+        self._ensure_activity_writer()
+        self._activity_queue.put(row)
+        return row
+    
+    def _ensure_activity_writer(self):
+        """Start the background batch writer on first use."""
+        if self._activity_writer is not None:
+            return
+        with self._writer_lock:
+            if self._activity_writer is None:
+                self._activity_writer = threading.Thread(
+                    target=self._activity_writer_loop, name="activity-writer", daemon=True
+                )
+                self._activity_writer.start()
+    
+    def _activity_writer_loop(self):
+        """
+        Collect up to ACTIVITY_BATCH_SIZE rows or ACTIVITY_FLUSH_INTERVAL, then
+        write them. A flush marker (threading.Event) ends the batch early and is
+        set once every row queued before it has been written.
+        """
+        while True:
+            batch = []
+            markers = []
+            item = self._activity_queue.get()
+            deadline = time.monotonic() + ACTIVITY_FLUSH_INTERVAL
+            while True:
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if markers or len(batch) >= ACTIVITY_BATCH_SIZE:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._activity_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write_activities(batch)
+            finally:
+                for marker in markers:
+                    marker.set()
+                for _ in range(len(batch) + len(markers)):
+                    self._activity_queue.task_done()
+    
+    def _write_activities(self, rows: list):
+        """Write a batch in one transaction; if that fails, retry row by row."""
+        try:
+            self._insert_activities(rows)
+            return
+        except Exception as e:
+            if len(rows) == 1:
+                print(f"Warning: Could not log activity {rows[0]['activity_type']} for {rows[0]['email']}: {e}")
+                return
+            print(f"Warning: Could not log {len(rows)} activities, retrying one by one: {e}")
+        
+        # One bad row (or a dropped connection) should not lose the whole batch
+        for row in rows:
+            try:
+                self._insert_activities([row])
+            except Exception as e:
+                print(f"Warning: Could not log activity {row['activity_type']} for {row['email']}: {e}")
+    
+    def _insert_activities(self, rows: list):
         db = SessionLocal()
         try:
-            user = db.query(User).filter(User.email == email).first()
-            if not user:
-                user = User(email=email)
-                db.add(user)
-                db.commit()
-                db.refresh(user)
+            user_ids = self._resolve_user_ids(db, {row["email"] for row in rows})
+            records = [
+                {
+                    "user_id": user_ids[row["email"]],
+                    "activity_type": row["activity_type"],
+                    "details": row["details"],
+                    "created_at": row["created_at"]
+                }
+                for row in rows
+            ]
+            
+            # Fold the rows into each user's stored stats, in the same transaction
+            # as the inserts so counters and activity rows never disagree
+            deltas = {}
+            for record in records:
+                stats = deltas.setdefault(record["user_id"], User.empty_stats())
+                User.accumulate_stats(stats, record["activity_type"], record["details"])
             
-            activity = Activity(
-                user_id=user.id,
-                activity_type=activity_type,
-                details=details or {}
-            )
-            db.add(activity)
+            db.execute(insert(Activity), records)
+            for user_id, delta in deltas.items():
+                db.execute(User.increment_stats(user_id, delta))
             db.commit()
-            return activity
+        except Exception:
+            db.rollback()
+            raise
         finally:
             db.close()
     
-    def get_user_activities(self, email: str, limit: int = 50) -> list:
+    def flush_activities(self):
+        """
+        Wait until activities logged before this call are written, so reads
+        see them. Rows logged afterwards by other requests are not waited for.
+        """
+        if self._activity_writer is None:
+            return
+        marker = threading.Event()
+        self._activity_queue.put(marker)
+        if not marker.wait(ACTIVITY_FLUSH_TIMEOUT):
+            print(f"Warning: Activity writer did not catch up within {ACTIVITY_FLUSH_TIMEOUT}s")
+    
+    def drain_activities(self):
+        """Write every queued activity before the process exits."""
+        if self._activity_writer is not None:
+            self._activity_queue.join()
+    
+    def get_user_activities(self, email: str, limit: int = 50, db: Optional[Session] = None) -> list:
         """Get user's activities."""
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User, Activity
-            db = SessionLocal()
-            try:
+            self.flush_activities()
+            with self._session(db) as db:
                 user = db.query(User).filter(User.email == email).first()
                 if not user:
                     return []
                 activities = db.query(Activity).filter(Activity.user_id == user.id)\
                     .order_by(Activity.created_at.desc()).limit(limit).all()
                 return [a.to_dict() for a in activities]
-            finally:
-                db.close()
         else:
             user = self.users_memory.get(email)
             if not user:
                 return []
             return [a.to_dict() for a in reversed(user.activities)][:limit]
     
-    def get_user_profile(self, email: str) -> Optional[dict]:
+    def get_user_profile(self, email: str, db: Optional[Session] = None) -> Optional[dict]:
         """Get user profile with stats."""
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            from sqlalchemy.orm import joinedload
-            db = SessionLocal()
-            try:
-                user = db.query(User).options(joinedload(User.activities)).filter(User.email == email).first()
+            self.flush_activities()
+            with self._session(db) as db:
+                self._ensure_stats_backfilled(db)
+                user = db.query(User).filter(User.email == email).first()
                 if not user:
                     return None
-                # _ = user.activities # No longer needed with joinedload
-                return user.to_dict(include_activities=False)
-            finally:
-                db.close()
+                # Stats come from stored counters; activities are never loaded
+                return user.to_dict(include_activities=False, stats=self._user_stats(db, user))
         else:
             user = self.users_memory.get(email)
             if not user:
                 return None
             return user.to_dict(include_activities=False)
     
-    def get_all_users(self) -> list:
+    def get_all_users(self, db: Optional[Session] = None) -> list:
         """Get list of all users."""
         if self.use_database:
-            from app.core.database import SessionLocal
-            from app.core.models import User
-            db = SessionLocal()
-            try:
-                users = db.query(User).all()
-                return [u.to_dict() for u in users]
-            finally:
-                db.close()
+            self.flush_activities()
+            with self._session(db) as db:
+                # Stats are plain columns on each user row: one query of plain
+                # rows, no User instances, activity loading or per-user aggregation
+                self._ensure_stats_backfilled(db)
+                rows = db.execute(select(*User.list_columns())).all()
+                stats = {row.id: User.stats_from_columns(row) for row in rows}
+                
+                # Rows the backfill missed are aggregated together, not one query per user
+                missing = [user_id for user_id, user_stats in stats.items() if user_stats is None]
+                stats.update(User.get_stats_sql_many(db, missing))
+                return [User.row_to_dict(row, stats[row.id]) for row in rows]
         else:
             return [u.to_dict() for u in self.users_memory.values()]
     
-    def get_users_by_risk_category(self) -> dict:
+    def get_users_by_risk_category(self, db: Optional[Session] = None, users: Optional[list] = None) -> dict:
         """Get all users grouped by plagiarism risk level.
         
         Risk Categories:
@@ -326,8 +463,11 @@ class UserManager:
         - medium_risk: 50% - 80%
         - normal_risk: 20% - 50%
         - clean: < 20%
+        
+        Pass `users` (from get_all_users) to avoid loading them again.
         """
-        users = self.get_all_users()
+        if users is None:
+            users = self.get_all_users(db)
         
         categories = {
             "high_risk": [],      # > 80%
@@ -361,10 +501,10 @@ class UserManager:
         
         return categories
     
-    def get_admin_dashboard_data(self) -> dict:
+    def get_admin_dashboard_data(self, db: Optional[Session] = None) -> dict:
         """Get comprehensive admin dashboard data."""
-        users = self.get_all_users()
-        risk_categories = self.get_users_by_risk_category()
+        users = self.get_all_users(db)
+        risk_categories = self.get_users_by_risk_category(users=users)
         
         # Calculate summary stats
         total_users = len(users)
@@ -1,15 +1,30 @@
-from fastapi import FastAPI, HTTPException, UploadFile, Header
+from fastapi import FastAPI, HTTPException, UploadFile, Header, Depends, Request, Response
 from pydantic import BaseModel, field_validator
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from typing import Optional, Any, Literal
+import asyncio
+import codecs
+import os
 import re
-from app.core.detector import detector
+from app.core.detector import get_detector
 from app.core.user_manager import user_manager
 from app.core.feedback_manager import feedback_manager
 from app.core.adaptive_engine import adaptive_engine
-from app.core.database import init_db
+from app.core.database import init_db, get_db
+from app.core.models import User
+from app.core.auth import create_access_token, verify_token, create_reset_token, verify_reset_token
+from sqlalchemy.orm import Session
 
-app = FastAPI(title="Plagiarism Detection Agent")
+# orjson serializes the large match/reference payloads much faster than stdlib json
+app = FastAPI(title="Plagiarism Detection Agent", default_response_class=ORJSONResponse)
+
+# Files of one request analysed at once, each detection in a worker thread
+FILE_DETECT_CONCURRENCY = 8
+
+# Bytes read per call when decoding an uploaded file
+UPLOAD_READ_CHUNK = 64 * 1024
 
 # Initialize database on startup
 @app.on_event("startup")
@@ -20,16 +35,44 @@ async def startup_event():
     except Exception as e:
         print(f"Warning: Database initialization failed: {e}")
         print("The app will continue with in-memory storage if database is unavailable.")
+    
+    # Pay the model and reference load once here, not on the first request
+    get_detector().warm_up()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Activity logging is batched in the background; write what is still queued
+    user_manager.drain_activities()
+
+# Enable CORS for frontend. Explicit origins (comma-separated CORS_ORIGINS,
+# default: the Vite dev server) let the middleware answer with a fixed header
+CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
 
-# Enable CORS for frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allow all for dev
+    allow_origins=[origin.strip() for origin in CORS_ORIGINS],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Browsers cache preflight responses for a day
 )
 
+# Compress large JSON responses (reference lists, match arrays, activity history)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Email pattern, compiled once for all validators
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+EMAIL_MAX_LENGTH = 254  # RFC 5321 limit; also bounds regex backtracking on hostile input
+
+def _normalize_email(v):
+    """Validate an email address and return it stripped and lower-cased."""
+    email = v.strip() if v else ""
+    if not email:
+        raise ValueError('Email cannot be empty')
+    if len(email) > EMAIL_MAX_LENGTH or not EMAIL_RE.match(email):
+        raise ValueError('Please enter a valid email address')
+    return email.lower()
+
 class Submission(BaseModel):
     text: str
     language: str = "en"
@@ -47,13 +90,7 @@ class UserLogin(BaseModel):
     @field_validator('email')
     @classmethod
     def validate_email(cls, v):
-        # Email regex pattern
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not v or not v.strip():
-            raise ValueError('Email cannot be empty')
-        if not re.match(email_pattern, v.strip()):
-            raise ValueError('Please enter a valid email address')
-        return v.strip().lower()
+        return _normalize_email(v)
     
     @field_validator('password')
     @classmethod
@@ -71,12 +108,7 @@ class UserRegister(BaseModel):
     @field_validator('email')
     @classmethod
     def validate_email(cls, v):
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not v or not v.strip():
-            raise ValueError('Email cannot be empty')
-        if not re.match(email_pattern, v.strip()):
-            raise ValueError('Please enter a valid email address')
-        return v.strip().lower()
+        return _normalize_email(v)
     
     @field_validator('password')
     @classmethod
@@ -85,20 +117,33 @@ class UserRegister(BaseModel):
             raise ValueError('Password must be at least 6 characters')
         return v
 
+async def _read_text(file: UploadFile) -> Optional[str]:
+    """Decode an uploaded file as UTF-8 in UPLOAD_READ_CHUNK pieces; None if it is not valid UTF-8."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts = []
+    try:
+        while chunk := await file.read(UPLOAD_READ_CHUNK):
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+    except UnicodeDecodeError:
+        return None
+    return "".join(parts)
+
 # ============== User Endpoints ==============
+# Endpoints doing only blocking work (DB queries, bcrypt, model encode) are
+# plain `def`: FastAPI runs them in its threadpool, off the event loop
 
 @app.post("/user/register")
-async def user_register(register: UserRegister):
+def user_register(register: UserRegister, db: Session = Depends(get_db)):
     """Register a new user with email and password."""
     if register.password != register.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match")
     
-    user_dict, error = user_manager.register_user(register.email, register.password)
+    user_dict, error = user_manager.register_user(register.email, register.password, db)
     if error:
         raise HTTPException(status_code=400, detail=error)
     
     # Create JWT token
-    from app.core.auth import create_access_token
     token = create_access_token(user_dict["email"])
     
     return {
@@ -110,14 +155,13 @@ async def user_register(register: UserRegister):
 
 
 @app.post("/user/login")
-async def user_login(login: UserLogin):
+def user_login(login: UserLogin, db: Session = Depends(get_db)):
     """Login with email and password."""
-    user_dict, error = user_manager.authenticate_user(login.email, login.password)
+    user_dict, error = user_manager.authenticate_user(login.email, login.password, db)
     if error:
         raise HTTPException(status_code=401, detail=error)
     
     # Create JWT token
-    from app.core.auth import create_access_token
     token = create_access_token(user_dict["email"])
     
     return {
@@ -128,19 +172,18 @@ async def user_login(login: UserLogin):
 
 
 @app.get("/user/me")
-async def get_current_user(authorization: str = Header(None)):
+def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
     """Get current user from JWT token."""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
     
     token = authorization.replace("Bearer ", "")
     
-    from app.core.auth import verify_token
     email = verify_token(token)
     if not email:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
-    user = user_manager.get_user(email)
+    user = user_manager.get_user(email, db)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -153,12 +196,7 @@ class ForgotPasswordRequest(BaseModel):
     @field_validator('email')
     @classmethod
     def validate_email(cls, v):
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not v or not v.strip():
-            raise ValueError('Email cannot be empty')
-        if not re.match(email_pattern, v.strip()):
-            raise ValueError('Please enter a valid email address')
-        return v.strip().lower()
+        return _normalize_email(v)
 
 
 class ResetPasswordRequest(BaseModel):
@@ -175,16 +213,15 @@ class ResetPasswordRequest(BaseModel):
 
 
 @app.post("/user/forgot-password")
-async def forgot_password(request: ForgotPasswordRequest):
+def forgot_password(request: ForgotPasswordRequest, db: Session = Depends(get_db)):
     """Request a password reset token. In production, this would send an email."""
-    if not user_manager.check_user_exists(request.email):
+    if not user_manager.check_user_exists(request.email, db):
         # Don't reveal if user exists or not for security
         return {
             "status": "success",
             "message": "If an account with this email exists, a reset link has been sent."
         }
     
-    from app.core.auth import create_reset_token
     reset_token = create_reset_token(request.email)
     
     # In a real app, you would email this token to the user
@@ -197,18 +234,17 @@ async def forgot_password(request: ForgotPasswordRequest):
 
 
 @app.post("/user/reset-password")
-async def reset_password(request: ResetPasswordRequest):
+def reset_password(request: ResetPasswordRequest, db: Session = Depends(get_db)):
     """Reset password using a reset token."""
     if request.new_password != request.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match")
     
-    from app.core.auth import verify_reset_token
     email = verify_reset_token(request.token)
     
     if not email:
         raise HTTPException(status_code=400, detail="Invalid or expired reset token")
     
-    success, error = user_manager.reset_password(email, request.new_password)
+    success, error = user_manager.reset_password(email, request.new_password, db)
     if not success:
         raise HTTPException(status_code=400, detail=error)
     
@@ -218,23 +254,23 @@ async def reset_password(request: ResetPasswordRequest):
     }
 
 @app.get("/user/profile/{username}")
-async def get_user_profile(username: str):
+def get_user_profile(username: str, db: Session = Depends(get_db)):
     """Get a user's profile and stats."""
-    profile = user_manager.get_user_profile(username)
+    profile = user_manager.get_user_profile(username, db)
     if not profile:
         raise HTTPException(status_code=404, detail=f"User '{username}' not found")
     return profile
 
 @app.get("/user/activities/{username}")
-async def get_user_activities(username: str, limit: int = 50):
+def get_user_activities(username: str, limit: int = 50, db: Session = Depends(get_db)):
     """Get a user's activity history."""
-    activities = user_manager.get_user_activities(username, limit)
+    activities = user_manager.get_user_activities(username, limit, db)
     return {"username": username, "activities": activities, "total": len(activities)}
 
 @app.get("/users")
-async def list_users():
+def list_users(db: Session = Depends(get_db)):
     """List all users."""
-    return {"users": user_manager.get_all_users()}
+    return {"users": user_manager.get_all_users(db)}
 
 # ============== Detection Endpoints ==============
 
@@ -247,7 +283,7 @@ async def detect_plagiarism(submission: Submission):
     if not submission.text.strip():
         raise HTTPException(status_code=400, detail="Text cannot be empty")
     
-    result = detector.detect(submission.text)
+    result = await asyncio.to_thread(get_detector().detect, submission.text)
     
     # Log activity if username provided
     if submission.username:
@@ -257,24 +293,33 @@ async def detect_plagiarism(submission: Submission):
             "matches_found": len(result.get("matches", []))
         })
     
-    return result
+    # Returning a response directly skips re-validating the matches against
+    # DetectionResult; only its fields are sent, as response_model did
+    return ORJSONResponse({
+        "max_score": result["max_score"],
+        "matches": result["matches"],
+        "stylometry": result.get("stylometry")
+    })
 
 @app.post("/add_reference")
-async def add_reference(doc_id: str, text: str):
-    detector.add_document(doc_id, text)
+def add_reference(doc_id: str, text: str):
+    result = get_detector().add_document(doc_id, text)
+    if result["status"] == "exists":
+        raise HTTPException(status_code=409, detail=f"Reference '{doc_id}' already exists")
+    if result["status"] == "error":
+        raise HTTPException(status_code=500, detail=f"Could not save reference '{doc_id}'")
     return {"status": "added", "doc_id": doc_id}
 
 @app.post("/upload_references")
 async def upload_references(files: list[UploadFile], x_username: Optional[str] = Header(None)):
     """Upload multiple files to be added to the reference database."""
     results = []
-    success_count = 0
+    pending = []  # (doc_id, text) pairs added in one batch after validation
+    pending_results = []  # Position in results of each pending pair
     
     for file in files:
-        content = await file.read()
-        try:
-            text = content.decode("utf-8")
-        except UnicodeDecodeError:
+        text = await _read_text(file)
+        if text is None:
             results.append({
                 "filename": file.filename,
                 "status": "error",
@@ -290,61 +335,61 @@ async def upload_references(files: list[UploadFile], x_username: Optional[str] =
             })
             continue
 
-        # Use filename as doc_id
-        doc_id = file.filename
-        
-        # Check for duplicate reference
-        if detector.document_exists(doc_id):
-            results.append({
-                "filename": file.filename,
-                "status": "skipped",
-                "message": f"Reference '{doc_id}' already exists. Skipped duplicate."
-            })
-            continue
-        
-        detector.add_document(doc_id, text)
-        success_count += 1
-        
-        results.append({
-            "filename": file.filename,
-            "status": "success",
-            "message": f"Added to reference database as '{doc_id}'"
-        })
+        # Use filename as doc_id; the result is filled in after the batch add
+        pending.append((file.filename, text))
+        pending_results.append(len(results))
+        results.append(None)
+    
+    # Batched encode + bulk insert, off the event loop. The detector checks
+    # for duplicates itself, so concurrent uploads cannot both add a doc_id
+    added_ids = []
+    if pending:
+        outcomes = await asyncio.to_thread(get_detector().add_documents, pending)
+        for pos, outcome in zip(pending_results, outcomes):
+            doc_id = outcome["doc_id"]
+            if outcome["status"] == "added":
+                added_ids.append(doc_id)
+                result = {"status": "success", "message": f"Added to reference database as '{doc_id}'"}
+            elif outcome["status"] == "exists":
+                result = {"status": "skipped", "message": f"Reference '{doc_id}' already exists. Skipped duplicate."}
+            else:
+                result = {"status": "error", "message": f"Could not save reference '{doc_id}'."}
+            results[pos] = {"filename": doc_id, **result}
+    success_count = len(added_ids)
     
     # Log activity if username provided
     if x_username and success_count > 0:
         user_manager.log_activity(x_username, "reference_add", {
             "count": success_count,
-            "filenames": [r["filename"] for r in results if r["status"] == "success"]
+            "filenames": added_ids
         })
     
-    return {"uploaded": results, "total_references": len(detector.documents)}
+    total_references = await asyncio.to_thread(get_detector().get_document_count)
+    return {"uploaded": results, "total_references": total_references}
 
 @app.get("/list_references")
-async def list_references():
+def list_references(request: Request):
     """List all documents in the reference database."""
-    docs = detector.get_all_documents()
-    refs = []
-    for doc in docs:
-        refs.append({
-            "doc_id": doc["id"],
-            "preview": doc["text"][:100] + "..." if len(doc["text"]) > 100 else doc["text"]
-        })
-    return {"references": refs, "count": len(refs)}
+    # Previews are cached until the references change; polling clients
+    # holding the current ETag get an empty 304 instead of the full list
+    etag, refs = get_detector().get_document_previews()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return ORJSONResponse({"references": refs, "count": len(refs)}, headers={"ETag": etag})
 
 @app.get("/reference/{doc_id}")
-async def get_reference(doc_id: str):
+def get_reference(doc_id: str):
     """Get the full content of a reference document."""
-    doc = detector.get_document(doc_id)
+    doc = get_detector().get_document(doc_id)
     if doc:
         return {"doc_id": doc_id, "text": doc["text"]}
     raise HTTPException(status_code=404, detail=f"Reference '{doc_id}' not found")
 
 @app.delete("/clear_references")
-async def clear_references(x_username: Optional[str] = Header(None)):
+def clear_references(x_username: Optional[str] = Header(None)):
     """Clear all reference documents from the database."""
-    count = len(detector.get_all_documents())
-    detector.clear_all_documents()
+    count = get_detector().get_document_count()
+    get_detector().clear_all_documents()
     
     if x_username and count > 0:
         user_manager.log_activity(x_username, "reference_delete", {
@@ -355,9 +400,9 @@ async def clear_references(x_username: Optional[str] = Header(None)):
     return {"status": "cleared", "message": "All reference documents have been removed."}
 
 @app.delete("/delete_reference/{doc_id}")
-async def delete_reference(doc_id: str, x_username: Optional[str] = Header(None)):
+def delete_reference(doc_id: str, x_username: Optional[str] = Header(None)):
     """Delete a single reference document by its ID."""
-    if not detector.remove_document(doc_id):
+    if not get_detector().remove_document(doc_id):
         raise HTTPException(status_code=404, detail=f"Reference '{doc_id}' not found")
     
     # Log activity
@@ -367,43 +412,63 @@ async def delete_reference(doc_id: str, x_username: Optional[str] = Header(None)
             "doc_id": doc_id
         })
     
-    return {"status": "deleted", "doc_id": doc_id, "remaining": len(detector.get_all_documents())}
+    return {"status": "deleted", "doc_id": doc_id, "remaining": get_detector().get_document_count()}
+
+def _text_error(text: Optional[str]) -> Optional[str]:
+    """Why an uploaded file's decoded text cannot be checked, or None if it can."""
+    if text is None:
+        return "Could not decode file. Please ensure it is a valid text file."
+    if not text.strip():
+        return "File is empty."
+    return None
+
+async def _detect_uploaded_files(files: list[UploadFile], detect) -> list:
+    """Run `detect(text)` on each uploaded file concurrently; results keep file order."""
+    semaphore = asyncio.Semaphore(FILE_DETECT_CONCURRENCY)
+    
+    async def process(file: UploadFile) -> dict:
+        # Assume UTF-8 text files for now
+        text = await _read_text(file)
+        error = _text_error(text)
+        if error:
+            return {"filename": file.filename, "error": error}
+
+        # Run detection in a worker thread, keeping the event loop free
+        async with semaphore:
+            detection_data = await asyncio.to_thread(detect, text)
+        
+        return {
+            "filename": file.filename,
+            "result": detection_data
+        }
+    
+    return await asyncio.gather(*(process(file) for file in files))
 
 @app.post("/detect_files")
 async def detect_files(files: list[UploadFile], x_username: Optional[str] = Header(None)):
     results = []
+    pending = []  # (position in results, text), detected in one batch below
     
     for file in files:
-        # Read file content
-        content = await file.read()
-        try:
-            # Assume UTF-8 text files for now
-            text = content.decode("utf-8")
-        except UnicodeDecodeError:
-            results.append({
-                "filename": file.filename,
-                "error": "Could not decode file. Please ensure it is a valid text file."
-            })
+        # Assume UTF-8 text files for now
+        text = await _read_text(file)
+        error = _text_error(text)
+        if error:
+            results.append({"filename": file.filename, "error": error})
             continue
-
-        if not text.strip():
-            results.append({
-                "filename": file.filename,
-                "error": "File is empty."
-            })
-            continue
-
-        # Run detection
-        detection_data = detector.detect(text)
-        
-        results.append({
-            "filename": file.filename,
-            "result": detection_data
-        })
+        results.append({"filename": file.filename})
+        pending.append((len(results) - 1, text))
+    
+    # All files are encoded in one batched call, off the event loop
+    max_score = 0
+    if pending:
+        detections = await asyncio.to_thread(get_detector().detect_many, [text for _, text in pending])
+        for (pos, _), detection_data in zip(pending, detections):
+            results[pos]["result"] = detection_data
+            max_score = max(max_score, detection_data.get("max_score", 0))
     
     # Log activity if username provided
     if x_username and results:
-        max_score = max([r.get("result", {}).get("max_score", 0) for r in results if "result" in r], default=0)
         user_manager.log_activity(x_username, "file_check", {
             "file_count": len(files),
             "filenames": [f.filename for f in files],
@@ -418,29 +483,16 @@ class FeedbackSubmission(BaseModel):
     doc_id: str
     submitted_text: str
     match_score: float
-    feedback_type: str  # 'false_positive' or 'confirmed'
+    # Literal fields are checked by pydantic-core, with no Python validator call
+    feedback_type: Literal['false_positive', 'confirmed']
     severity: Optional[int] = 50  # 0-100 plagiarism severity
-    detection_layer: Optional[str] = None  # semantic/stylometry/cross_lang/paraphrase
+    detection_layer: Optional[Literal['semantic', 'stylometry', 'cross_lang', 'paraphrase']] = None
     confidence_override: Optional[int] = None  # User's suggested confidence
     notes: Optional[str] = None  # Reviewer notes
-    
-    @field_validator('feedback_type')
-    @classmethod
-    def validate_feedback_type(cls, v):
-        if v not in ('false_positive', 'confirmed'):
-            raise ValueError("feedback_type must be 'false_positive' or 'confirmed'")
-        return v
-    
-    @field_validator('detection_layer')
-    @classmethod
-    def validate_detection_layer(cls, v):
-        if v is not None and v not in ('semantic', 'stylometry', 'cross_lang', 'paraphrase'):
-            raise ValueError("detection_layer must be one of: semantic, stylometry, cross_lang, paraphrase")
-        return v
 
 
 @app.post("/feedback")
-async def submit_feedback(feedback: FeedbackSubmission, x_username: Optional[str] = Header(None)):
+def submit_feedback(feedback: FeedbackSubmission, x_username: Optional[str] = Header(None)):
     """Submit feedback on a plagiarism detection result for model improvement."""
     try:
         result = feedback_manager.submit_feedback(
@@ -471,28 +523,30 @@ async def submit_feedback(feedback: FeedbackSubmission, x_username: Optional[str
 
 
 @app.get("/feedback/stats")
-async def get_feedback_stats():
+def get_feedback_stats():
     """Get basic feedback statistics and learning status."""
     return feedback_manager.get_stats()
 
 
 @app.get("/feedback/history")
-async def get_feedback_history(limit: int = 20):
+def get_feedback_history(limit: int = 20):
     """Get recent feedback entries."""
     history = feedback_manager.get_history(limit)
     return {"history": history, "count": len(history)}
 
 
 @app.get("/feedback/analytics")
-async def get_feedback_analytics():
+def get_feedback_analytics(db: Session = Depends(get_db)):
     """Get detailed feedback analytics including layer breakdown and thresholds."""
-    return adaptive_engine.get_analytics()
+    return adaptive_engine.get_analytics(db)
 
 
 @app.post("/feedback/retrain")
-async def trigger_retrain(x_username: Optional[str] = Header(None)):
+def trigger_retrain(x_username: Optional[str] = Header(None), db: Session = Depends(get_db)):
     """Trigger incremental retraining based on accumulated feedback."""
-    result = adaptive_engine.trigger_retrain()
+    result = adaptive_engine.trigger_retrain(db)
+    if result["status"] == "retrain_in_progress":
+        raise HTTPException(status_code=409, detail="Retrain already in progress")
     
     # Log activity
     if x_username:
@@ -504,32 +558,25 @@ async def trigger_retrain(x_username: Optional[str] = Header(None)):
 
 
 @app.get("/learning/weights")
-async def get_learning_weights():
+def get_learning_weights(db: Session = Depends(get_db)):
     """Get current adaptive layer weights and threshold settings."""
-    return adaptive_engine.get_or_create_weights()
+    return adaptive_engine.get_or_create_weights(db)
 
 
 @app.post("/user/role/{username}")
-async def update_user_role(username: str, role: str, x_username: Optional[str] = Header(None)):
+def update_user_role(username: str, role: str, x_username: Optional[str] = Header(None), db: Session = Depends(get_db)):
     """Update a user's role (admin only)."""
     if role not in ('user', 'instructor', 'admin'):
         raise HTTPException(status_code=400, detail="Role must be: user, instructor, or admin")
     
-    from app.core.database import SessionLocal
-    from app.core.models import User
+    user = db.query(User).filter(User.email == username).first()
+    if not user:
+        raise HTTPException(status_code=404, detail=f"User '{username}' not found")
     
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.email == username).first()
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User '{username}' not found")
-        
-        user.role = role
-        db.commit()
-        
-        return {"status": "success", "username": username, "new_role": role}
-    finally:
-        db.close()
+    user.role = role
+    db.commit()
+    
+    return {"status": "success", "username": username, "new_role": role}
 
 
 # ============== Cross-User Plagiarism Detection Endpoints ==============
@@ -543,13 +590,11 @@ async def upload_documents(files: list[UploadFile], x_username: str = Header(...
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
     results = []
-    success_count = 0
+    pending = []  # (position in results, doc_id, text), stored in one batch below
     
     for file in files:
-        content = await file.read()
-        try:
-            text = content.decode("utf-8")
-        except UnicodeDecodeError:
+        text = await _read_text(file)
+        if text is None:
             results.append({
                 "filename": file.filename,
                 "status": "error",
@@ -566,23 +611,29 @@ async def upload_documents(files: list[UploadFile], x_username: str = Header(...
             continue
 
         # Store document with user ownership
-        doc_id = file.filename
-        store_result = detector.store_user_document(x_username, doc_id, text)
-        
+        results.append(None)
+        pending.append((len(results) - 1, file.filename, text))
+    
+    store_results = await asyncio.to_thread(
+        get_detector().store_user_documents, x_username, [(doc_id, text) for _, doc_id, text in pending]
+    ) if pending else []
+    
+    success_count = 0
+    for (pos, doc_id, _), store_result in zip(pending, store_results):
         if store_result["status"] == "exists":
-            results.append({
-                "filename": file.filename,
+            results[pos] = {
+                "filename": doc_id,
                 "status": "skipped",
                 "message": f"Document '{doc_id}' already exists in your uploads."
-            })
+            }
         else:
             success_count += 1
-            results.append({
-                "filename": file.filename,
+            results[pos] = {
+                "filename": doc_id,
                 "status": "success",
                 "message": f"Stored as '{doc_id}'",
                 "language": store_result.get("language", {})
-            })
+            }
     
     # Log activity
     if success_count > 0:
@@ -591,30 +642,35 @@ async def upload_documents(files: list[UploadFile], x_username: str = Header(...
             "filenames": [r["filename"] for r in results if r["status"] == "success"]
         })
     
+    # Count queries hit the database, so run them off the event loop too
+    total_user_documents, total_system_documents = await asyncio.gather(
+        asyncio.to_thread(get_detector().count_user_documents, x_username),
+        asyncio.to_thread(get_detector().get_all_user_documents_count)
+    )
     return {
         "uploaded": results,
-        "total_user_documents": len(detector.get_user_documents(x_username)),
-        "total_system_documents": detector.get_all_user_documents_count()
+        "total_user_documents": total_user_documents,
+        "total_system_documents": total_system_documents
     }
 
 
 @app.get("/my_documents")
-async def get_my_documents(x_username: str = Header(...)):
+def get_my_documents(x_username: str = Header(...)):
     """Get all documents uploaded by the current user."""
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    docs = detector.get_user_documents(x_username)
+    docs = get_detector().get_user_documents(x_username)
     return {"documents": docs, "count": len(docs)}
 
 
 @app.delete("/my_documents/{doc_id}")
-async def delete_my_document(doc_id: str, x_username: str = Header(...)):
+def delete_my_document(doc_id: str, x_username: str = Header(...)):
     """Delete one of the current user's uploaded documents."""
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    if not detector.delete_user_document(x_username, doc_id):
+    if not get_detector().delete_user_document(x_username, doc_id):
         raise HTTPException(status_code=404, detail=f"Document '{doc_id}' not found in your uploads")
     
     # Log activity
@@ -639,7 +695,7 @@ async def detect_cross_user_plagiarism(submission: CrossUserSubmission):
     if not submission.username:
         raise HTTPException(status_code=400, detail="Username is required")
     
-    result = detector.detect_cross_user(submission.text, submission.username)
+    result = await asyncio.to_thread(get_detector().detect_cross_user, submission.text, submission.username)
     
     # Log activity
     user_manager.log_activity(submission.username, "cross_user_check", {
@@ -660,37 +716,13 @@ async def detect_files_cross_user(files: list[UploadFile], x_username: str = Hea
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    results = []
-    
-    for file in files:
-        content = await file.read()
-        try:
-            text = content.decode("utf-8")
-        except UnicodeDecodeError:
-            results.append({
-                "filename": file.filename,
-                "error": "Could not decode file. Please ensure it is a valid text file."
-            })
-            continue
-
-        if not text.strip():
-            results.append({
-                "filename": file.filename,
-                "error": "File is empty."
-            })
-            continue
-
-        # Run cross-user detection
-        detection_data = detector.detect_cross_user(text, x_username)
-        
-        results.append({
-            "filename": file.filename,
-            "result": detection_data
-        })
+    # Run cross-user detection
+    detector = get_detector()
+    results = await _detect_uploaded_files(files, lambda text: detector.detect_cross_user(text, x_username))
     
     # Log activity
     if results:
-        max_score = max([r.get("result", {}).get("max_score", 0) for r in results if "result" in r], default=0)
+        max_score = max((r["result"].get("max_score", 0) for r in results if "result" in r), default=0)
         user_manager.log_activity(x_username, "cross_user_file_check", {
             "file_count": len(files),
             "filenames": [f.filename for f in files],
@@ -701,28 +733,20 @@ async def detect_files_cross_user(files: list[UploadFile], x_username: str = Hea
 
 
 @app.get("/system_documents_count")
-async def get_system_documents_count():
+def get_system_documents_count():
     """Get the total count of user documents in the system."""
-    return {"total": detector.get_all_user_documents_count()}
+    return {"total": get_detector().get_all_user_documents_count()}
 
 
 # ============== Admin Dashboard Endpoints ==============
 
-def check_admin_role(email: str) -> bool:
+def check_admin_role(email: str, db: Session) -> bool:
     """Check if user has admin role."""
-    from app.core.database import SessionLocal
-    from app.core.models import User
-    
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.email == email).first()
-        return user and user.role == "admin"
-    finally:
-        db.close()
+    return db.query(User.role).filter(User.email == email).scalar() == "admin"
 
 
 @app.get("/admin/dashboard")
-async def get_admin_dashboard(x_username: str = Header(...)):
+def get_admin_dashboard(x_username: str = Header(...), db: Session = Depends(get_db)):
     """Get comprehensive admin dashboard data with user risk categorization.
     
     Risk Categories:
@@ -734,67 +758,60 @@ async def get_admin_dashboard(x_username: str = Header(...)):
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    if not check_admin_role(x_username):
+    if not check_admin_role(x_username, db):
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    return user_manager.get_admin_dashboard_data()
+    return user_manager.get_admin_dashboard_data(db)
 
 
 @app.get("/admin/users")
-async def get_all_users_admin(x_username: str = Header(...)):
+def get_all_users_admin(x_username: str = Header(...), db: Session = Depends(get_db)):
     """Get all users with full details (admin only)."""
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    if not check_admin_role(x_username):
+    if not check_admin_role(x_username, db):
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    return {"users": user_manager.get_all_users()}
+    return {"users": user_manager.get_all_users(db)}
 
 
 @app.get("/admin/risk-categories")
-async def get_risk_categories(x_username: str = Header(...)):
+def get_risk_categories(x_username: str = Header(...), db: Session = Depends(get_db)):
     """Get users grouped by risk category (admin only)."""
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    if not check_admin_role(x_username):
+    if not check_admin_role(x_username, db):
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    return user_manager.get_users_by_risk_category()
+    return user_manager.get_users_by_risk_category(db)
 
 
 @app.post("/admin/set-admin/{target_email}")
-async def set_user_as_admin(target_email: str, x_username: str = Header(...)):
+def set_user_as_admin(target_email: str, x_username: str = Header(...), db: Session = Depends(get_db)):
     """Set a user as admin (admin only)."""
     if not x_username:
         raise HTTPException(status_code=400, detail="Username header (x-username) is required")
     
-    if not check_admin_role(x_username):
+    if not check_admin_role(x_username, db):
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    from app.core.database import SessionLocal
-    from app.core.models import User
+    user = db.query(User).filter(User.email == target_email).first()
+    if not user:
+        raise HTTPException(status_code=404, detail=f"User '{target_email}' not found")
     
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.email == target_email).first()
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User '{target_email}' not found")
-        
-        user.role = "admin"
-        db.commit()
-        
-        return {"status": "success", "email": target_email, "role": "admin"}
-    finally:
-        db.close()
+    user.role = "admin"
+    db.commit()
+    
+    return {"status": "success", "email": target_email, "role": "admin"}
 
 
 @app.get("/admin/check")
-async def check_admin_access(x_username: str = Header(...)):
+def check_admin_access(x_username: str = Header(...), db: Session = Depends(get_db)):
     """Check if current user has admin access."""
     if not x_username:
         return {"is_admin": False}
     
-    return {"is_admin": check_admin_role(x_username)}
+    return {"is_admin": check_admin_role(x_username, db)}
 
@@ -36,7 +36,9 @@ def create_database():
             host=host,
             port=port,
             user=user,
-            password=password
+            password=password,
+            charset="utf8mb4",
+            autocommit=True
         )
         
         with connection.cursor() as cursor:
@@ -0,0 +1,27 @@
+"""
+Shared fixtures: a file-backed SQLite database standing in for MySQL.
+"""
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.core.database import Base
+from app.core import models  # noqa: F401  (registers the tables on Base)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Sessionmaker over a fresh SQLite file with every model table created."""
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+
+    @event.listens_for(engine, "connect")
+    def _register_functions(dbapi_connection, _):
+        # MySQL's GREATEST(), used by User.increment_stats
+        dbapi_connection.create_function("greatest", 2, max)
+
+    Base.metadata.create_all(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
@@ -0,0 +1,128 @@
+"""
+Tests for the reference index in PlagiarismDetector and its top-k selection.
+"""
+import hashlib
+
+import numpy as np
+import pytest
+import torch
+
+from app.core import detector as detector_module
+from app.core.detector import PlagiarismDetector, filter_top_k
+from app.core.models import ReferenceDocument
+
+DIM = 16
+
+
+class FakeModel:
+    """Deterministic stand-in for the SentenceTransformer: one unit vector per text."""
+    max_seq_length = 128
+
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+    def encode(self, texts, convert_to_tensor=False, **kwargs):
+        rows = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+            rows.append(np.random.default_rng(seed).standard_normal(DIM))
+        embeddings = torch.nn.functional.normalize(torch.tensor(np.array(rows), dtype=torch.float32), dim=1)
+        return embeddings if convert_to_tensor else embeddings.numpy()
+
+
+@pytest.fixture
+def detector(session_factory, monkeypatch):
+    detector = PlagiarismDetector()
+    detector.device = "cpu"
+    detector.__dict__["model"] = FakeModel()  # Skips the cached model download
+    monkeypatch.setattr(detector, "_get_db", session_factory)
+    yield detector
+    detector._stylometry_pool.shutdown(wait=False)
+
+
+def assert_consistent(detector):
+    """Parallel arrays, id map and embedding rows all describe the same documents."""
+    assert len(detector.doc_ids) == len(detector.doc_texts) == detector.embeddings.shape[0]
+    assert detector._id_to_index == {doc_id: i for i, doc_id in enumerate(detector.doc_ids)}
+    expected = FakeModel().encode(detector.doc_texts, convert_to_tensor=True)
+    assert torch.allclose(detector.embeddings, expected)
+
+
+def test_add_documents_reports_duplicates(detector):
+    results = detector.add_documents([
+        ("a", "first text"), ("b", "second text"), ("a", "repeated id")
+    ])
+    assert [r["status"] for r in results] == ["added", "added", "exists"]
+    assert "language" in results[0]
+
+    assert detector.add_document("a", "again")["status"] == "exists"
+    assert detector.doc_texts[detector._id_to_index["a"]] == "first text"
+    assert not detector._pending_ids
+    assert_consistent(detector)
+
+
+def test_add_documents_integrity_error_keeps_other_rows(detector, session_factory):
+    detector._load_from_db()
+    # Stored by another worker: in the database but not in this process's cache
+    with session_factory() as db:
+        db.add(ReferenceDocument(doc_id="c", text="other worker"))
+        db.commit()
+
+    results = detector.add_documents([("c", "third text"), ("d", "fourth text")])
+    assert [r["status"] for r in results] == ["exists", "added"]
+    assert detector.doc_ids == ["d"]
+    with session_factory() as db:
+        assert db.query(ReferenceDocument).count() == 2
+    assert_consistent(detector)
+
+
+def test_add_documents_database_failure_adds_nothing(detector, monkeypatch):
+    detector._load_from_db()
+
+    def broken_db():
+        raise RuntimeError("database down")
+
+    monkeypatch.setattr(detector, "_get_db", broken_db)
+    results = detector.add_documents([("a", "first text")])
+    assert [r["status"] for r in results] == ["error"]
+    assert detector.doc_ids == []
+    assert not detector._pending_ids
+
+
+def test_remove_document_keeps_index_consistent(detector):
+    detector.add_documents([(f"doc{i}", f"text number {i}") for i in range(6)])
+
+    assert detector.remove_document("doc1")  # Middle: the last document moves in
+    assert_consistent(detector)
+    assert detector.remove_document("doc4")  # Now the last one
+    assert_consistent(detector)
+    assert detector.remove_document("doc0")
+    assert_consistent(detector)
+    assert not detector.remove_document("doc1")
+
+    assert sorted(detector.doc_ids) == ["doc2", "doc3", "doc5"]
+    assert detector.get_document("doc5")["text"] == "text number 5"
+
+
+@pytest.mark.parametrize("size, threshold, k", [
+    (0, 0.5, 5),
+    (10, 0.5, 20),
+    (1000, 0.2, 20),
+    (1000, 0.99, 20),
+    (20000, 0.3, 1),
+])
+def test_filter_top_k_matches_numpy_reference(size, threshold, k):
+    scores = np.random.default_rng(size).random(size, dtype=np.float32)
+    ids, top_scores = filter_top_k(scores, threshold, k)
+
+    expected = np.argsort(-scores, kind="stable")
+    expected = expected[scores[expected] > threshold][:k]
+    np.testing.assert_array_equal(ids, expected)
+    np.testing.assert_array_equal(top_scores, scores[expected])
+
+
+def test_filter_top_k_numpy_path_for_large_arrays(monkeypatch):
+    monkeypatch.setattr(detector_module, "njit", None)
+    scores = np.random.default_rng(1).random(detector_module.NUMBA_MIN_DOCUMENTS + 1, dtype=np.float32)
+    ids, _ = filter_top_k(scores, 0.5, 20)
+    np.testing.assert_array_equal(ids, np.argsort(-scores, kind="stable")[:20])
@@ -0,0 +1,89 @@
+"""
+Tests for the batched activity writer in UserManager.
+"""
+import threading
+import time
+
+import pytest
+
+from app.core import user_manager as user_manager_module
+from app.core.models import Activity, User
+
+
+@pytest.fixture
+def manager(session_factory, monkeypatch):
+    monkeypatch.setattr(user_manager_module, "SessionLocal", session_factory)
+    manager = user_manager_module.UserManager()
+    assert manager.use_database
+    yield manager
+    manager.drain_activities()
+
+
+def test_flush_makes_earlier_activities_visible_in_order(manager):
+    for i in range(5):
+        manager.log_activity("a@example.com", "text_check", {"max_score": i * 10, "n": i})
+    manager.flush_activities()
+
+    activities = manager.get_user_activities("a@example.com")
+    assert sorted(a["details"]["n"] for a in activities) == [0, 1, 2, 3, 4]
+    profile = manager.get_user_profile("a@example.com")
+    assert profile["stats"]["text_checks"] == 5
+    assert profile["stats"]["highest_plagiarism_score"] == 40
+
+
+def test_flush_does_not_wait_for_later_activities(manager):
+    manager.log_activity("a@example.com", "text_check", {"max_score": 1})
+    stop = threading.Event()
+
+    def keep_logging():
+        while not stop.is_set():
+            manager.log_activity("b@example.com", "file_check", {"file_count": 1})
+
+    logger = threading.Thread(target=keep_logging)
+    logger.start()
+    try:
+        started = time.monotonic()
+        manager.flush_activities()
+        elapsed = time.monotonic() - started
+    finally:
+        stop.set()
+        logger.join()
+
+    assert elapsed < user_manager_module.ACTIVITY_FLUSH_TIMEOUT
+    assert len(manager.get_user_activities("a@example.com")) == 1
+
+
+def test_concurrent_first_activities_create_one_user(manager, session_factory):
+    threads = [
+        threading.Thread(target=manager.log_activity, args=("new@example.com", "text_check", {"max_score": 5}))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.flush_activities()
+
+    with session_factory() as db:
+        assert db.query(User).filter(User.email == "new@example.com").count() == 1
+        assert db.query(Activity).count() == 8
+
+
+def test_failed_row_does_not_drop_its_batch(manager, session_factory):
+    manager.log_activity("a@example.com", "text_check", {"max_score": 1})
+    manager.log_activity("a@example.com", "text_check", {"bad": object()})  # Not JSON serializable
+    manager.log_activity("a@example.com", "text_check", {"max_score": 3})
+    manager.flush_activities()
+
+    with session_factory() as db:
+        assert db.query(Activity).count() == 2
+
+
+def test_drain_writes_everything_queued(manager, session_factory):
+    for _ in range(300):
+        manager.log_activity("a@example.com", "reference_add", {"count": 1})
+    manager.drain_activities()
+
+    with session_factory() as db:
+        assert db.query(Activity).count() == 300
+        assert db.query(User.refs_added_sum).filter(User.email == "a@example.com").scalar() == 300
@@ -5,8 +5,9 @@ import os
 sys.path.append(os.getcwd())
 
 try:
-    from app.core.detector import detector
+    from app.core.detector import get_detector
     print("Imports OK")
+    detector = get_detector()
     
     # Run a test detection
     res = detector.detect("This is a test sentence for plagiarism detection.")